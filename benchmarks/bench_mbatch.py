@@ -0,0 +1,243 @@
+"""
+Benchmarks of the mbatch planner and submitter on synthetic pipelines.
+
+This generates example.yml-style configurations with a given number of
+stages in one of these shapes:
+
+chain    stage0 <- stage1 <- stage2 <- ...
+fanout   one stage that all others depend on
+diamond  repeated blocks of a stage, 8 stages that depend on it, and a
+         stage that depends on those 8 (and is depended on by the next block)
+loop     one stage, a looped stage over (N-2) arg values that depends on it,
+         and a stage that depends on the looped stage
+sweep    like loop, but with a sweep over a product of two lists with about
+         (N-2) points instead of the looped stage (N is then the number of
+         points, which are not stages of their own)
+
+and times
+1. unroll_stages, map_dependencies, has_loop and flatten, called directly
+2. reuse planning (the sacct query, output hashes and reuse checks) of
+   `mbatch --dry-run` against an index in which every stage is a SLURM job
+   that has not been seen finishing
+3. submission of every stage with `mbatch --no-reuse`, which writes the
+   batch scripts, calls sbatch for each job and parses the job IDs it
+   prints, and records the jobs in the index
+
+(2) and (3) run mbatch in a subprocess with --profile, against stub
+sbatch and sacct executables and a stub site configuration in a
+temporary directory, so this does not need SLURM. Their times are
+those of the profiled phases. The sbatch stub is a shell script that
+only hands out job IDs, so "submission" is mostly mbatch's own work plus
+the cost of starting a process per job, which a real sbatch adds its
+round trip to the controller to. Printing the summary is timed
+separately (as "summary").
+
+e.g.
+python benchmarks/bench_mbatch.py
+python benchmarks/bench_mbatch.py --sizes 10 1000 --shapes chain loop -o bench.json
+"""
+
+import os,sys,json,time,shutil,tempfile,subprocess
+import argparse
+import yaml
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from mbatch import mbatch
+
+SHAPES = ['chain','fanout','diamond','loop','sweep']
+SIZES = [10,1000,10000,100000]
+
+SITE = '''default_constraint: None
+default_part: None
+default_qos: None
+default_account: None
+architecture:
+  None:
+    None:
+      cores_per_node: 40
+      memory_per_node_gb: 180
+      threads_per_core: 1
+
+template: |
+  #!/bin/bash!CONSTRAINT!QOS!PARTITION!ACCOUNT
+  #SBATCH --nodes=!NODES
+  #SBATCH --time=!WALL
+  #SBATCH --ntasks-per-node=!TASKSPERNODE
+  #SBATCH --cpus-per-task=!THREADS
+  #SBATCH --job-name=!JOBNAME
+  #SBATCH --output=!OUT_%j.txt
+  export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+  !EXTRA
+  !CMD
+'''
+
+# Prints a new job ID for every submission, like sbatch --parsable
+SBATCH = '''#!/bin/sh
+fname="$(dirname "$0")/jobid"
+jobid=$(( $(cat "$fname" 2>/dev/null || echo 0) + 1 ))
+echo $jobid > "$fname"
+echo $jobid
+'''
+
+# Reports every job it is asked about as COMPLETED
+SACCT = '''#!/usr/bin/env python
+import sys
+jobids = sys.argv[sys.argv.index('-j')+1].split(',')
+print('\\n'.join([f'{jobid}|COMPLETED' for jobid in jobids]))
+'''
+
+def get_config(shape,nstages,root_dir,script):
+    '''An example.yml-style configuration of a pipeline with about nstages stages'''
+    def _stage(depends=None,**kwargs):
+        stage = {'exec': 'python', 'script': script, 'globals': ['lmin'],
+                 'options': {'nsims': 4},
+                 'parallel': {'nproc': 1, 'threads': 40, 'walltime': '00:15:00'}}
+        if depends is not None: stage['depends'] = depends
+        stage.update(kwargs)
+        return stage
+    stages = {}
+    if shape=='chain':
+        for i in range(nstages):
+            stages[f'stage{i}'] = _stage([f'stage{i-1}'] if i>0 else None)
+    elif shape=='fanout':
+        stages['stage0'] = _stage()
+        for i in range(1,nstages):
+            stages[f'stage{i}'] = _stage(['stage0'])
+    elif shape=='diamond':
+        width = 8
+        last = None
+        for b in range(max(1,nstages//(width+2))):
+            stages[f'split{b}'] = _stage([last] if last is not None else None)
+            for i in range(width):
+                stages[f'mid{b}_{i}'] = _stage([f'split{b}'])
+            last = f'join{b}'
+            stages[last] = _stage([f'mid{b}_{i}' for i in range(width)])
+    elif shape=='loop':
+        stages['stage0'] = _stage()
+        stages['loop'] = _stage(['stage0'],arg=[f'a{i}' for i in range(max(1,nstages-2))])
+        stages['final'] = _stage(['loop'])
+    elif shape=='sweep':
+        n1 = max(1,int(round((nstages-2)**0.5)))
+        n2 = max(1,(nstages-2)//n1)
+        stages['stage0'] = _stage()
+        stages['sweep'] = _stage(['stage0'],sweep={'product': {'lmax': list(range(n1)), 'seed': list(range(n2))}})
+        stages['final'] = _stage(['sweep'])
+    else:
+        raise ValueError(f"Unknown shape {shape}")
+    return {'root_dir': root_dir, 'globals': {'lmin': 100}, 'stages': stages}
+
+def best_time(func,repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        ret = func()
+        times.append(time.perf_counter()-t0)
+    return min(times),ret
+
+def bench_planner(config,repeat):
+    '''Times the planning functions on a config in this process'''
+    cstages = config['stages']
+    results = {}
+    results['unroll'],(ostages,unroll_map) = best_time(lambda: mbatch.unroll_stages(cstages),repeat)
+    results['dependencies'],(deps,depended) = best_time(lambda: mbatch.map_dependencies(ostages,unroll_map),repeat)
+    results['has_loop'],loop = best_time(lambda: mbatch.has_loop(deps),repeat)
+    if loop: raise ValueError("Synthetic pipeline has a loop")
+    results['flatten'],order = best_time(lambda: mbatch.flatten(deps),repeat)
+    results['nstages'] = len(ostages)
+    results['npoints'] = sum([1 if ostage.sweep is None else len(ostage.sweep) for ostage in ostages.values()])
+    return results,ostages
+
+def seed_index(root_dir,project,ostages,global_vals):
+    '''Records every stage as an unfinished SLURM job with an up-to-date config'''
+    fingerprints = mbatch.get_stage_fingerprints(ostages,global_vals)
+    git_fingerprints = mbatch.get_git_fingerprints(ostages,{},{})
+    records = {}
+    for i,stage in enumerate(ostages.keys()):
+        records[stage] = mbatch.get_index_record(str(100000000+i),'bench',None,fingerprints[stage],git_fingerprints[stage])
+        sweep = ostages[stage].sweep
+        if sweep is not None:
+            # One job array with all the points
+            records[stage]['sweep'] = sweep.spec
+            records[stage]['failed'] = f'0-{len(sweep)-1}'
+            records[stage]['chunks'] = [[records[stage]['jobid'],0]]
+    shutil.rmtree(mbatch.get_project_dir(root_dir,project),ignore_errors=True)
+    mbatch.save_index(root_dir,project,{'stages': records})
+
+def run_mbatch(work_dir,project,config_file,extra_args,dry_run=True):
+    '''Runs mbatch with --profile against the stubs and returns its profile'''
+    env = dict(os.environ)
+    env['HOME'] = os.path.join(work_dir,'home')
+    env['XDG_CACHE_HOME'] = os.path.join(work_dir,'cache')
+    env['PATH'] = os.path.join(work_dir,'bin') + os.pathsep + env.get('PATH','')
+    env['PYTHONPATH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..') + os.pathsep + env.get('PYTHONPATH','')
+    cmds = [sys.executable,'-c','from mbatch.mbatch import main; main()',project,config_file,
+            '--site','bench','--force-slurm','--profile'] + (['--dry-run'] if dry_run else []) + extra_args
+    t0 = time.perf_counter()
+    sp = subprocess.run(cmds,input=b'y\n',stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,cwd=work_dir,env=env)
+    wall = time.perf_counter()-t0
+    if sp.returncode!=0: raise RuntimeError(f"mbatch failed: {sp.stderr.decode('utf-8')}")
+    with open(os.path.join(work_dir,'output',project,'mbatch_profile.json'),'r') as f:
+        profile = json.load(f)
+    return wall,profile['phases']
+
+def setup_work_dir(work_dir):
+    os.makedirs(os.path.join(work_dir,'home','.mbatch'), exist_ok=True)
+    with open(os.path.join(work_dir,'home','.mbatch','bench.yml'),'w') as f:
+        f.write(SITE)
+    os.makedirs(os.path.join(work_dir,'bin'), exist_ok=True)
+    for name,content in [('sbatch',SBATCH),('sacct',SACCT)]:
+        fname = os.path.join(work_dir,'bin',name)
+        with open(fname,'w') as f:
+            f.write(content)
+        os.chmod(fname,0o755)
+    script = os.path.join(work_dir,'stage.py')
+    with open(script,'w') as f:
+        f.write('import argparse\n')
+    return script
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the mbatch planner and submitter on synthetic pipelines.')
+    parser.add_argument("--sizes", type=int, nargs='+', default=SIZES, help='Numbers of stages (or of points, for sweep).')
+    parser.add_argument("--shapes", nargs='+', default=SHAPES, choices=SHAPES, help='Shapes of the pipeline.')
+    parser.add_argument("--repeat", type=int, default=3, help='Number of repetitions of the planner benchmarks (the best is reported).')
+    parser.add_argument("--max-main-stages", type=int, default=10000, help='Only run mbatch itself for pipelines with at most this many stages.')
+    parser.add_argument("-o","--output", type=str, default=None, help='Save the results to this JSON file.')
+    parser.add_argument("--work-dir", type=str, default=None, help='Directory for the stubs and outputs. A temporary one is used (and removed) by default.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mbatch_bench_') if args.work_dir is None else os.path.abspath(args.work_dir)
+    script = setup_work_dir(work_dir)
+    root_dir = os.path.join(work_dir,'output')
+    columns = ['unroll','dependencies','has_loop','flatten','job states','reuse','summary','submission','wall (reuse)','wall (submit)']
+    print(f"{'shape':<8}{'stages':>8}" + ''.join([f'{c:>14}' for c in columns]))
+    results = []
+    try:
+        for shape in args.shapes:
+            for nstages in args.sizes:
+                config = get_config(shape,nstages,root_dir,script)
+                result,ostages = bench_planner(config,args.repeat)
+                result['shape'] = shape
+                if result['nstages']<=args.max_main_stages:
+                    config_file = os.path.join(work_dir,f'{shape}_{nstages}.yml')
+                    with open(config_file,'w') as f:
+                        yaml.dump(config,f,default_flow_style=False)
+                    project = f'{shape}_{nstages}'
+                    seed_index(root_dir,project,ostages,config['globals'])
+                    result['wall (reuse)'],phases = run_mbatch(work_dir,project,config_file,[])
+                    result['job states'] = phases.get('job states',{}).get('seconds',None)
+                    result['reuse'] = sum([phases.get(p,{}).get('seconds',0.) for p in ['output hashes','reuse']])
+                    result['summary'] = phases['summary']['seconds']
+                    project = f'{shape}_{nstages}_submit'
+                    shutil.rmtree(mbatch.get_project_dir(root_dir,project),ignore_errors=True)
+                    result['wall (submit)'],phases = run_mbatch(work_dir,project,config_file,['--no-reuse','--yes'],dry_run=False)
+                    result['submission'] = phases['submission']['seconds']
+                results.append(result)
+                print(f"{shape:<8}{result['npoints']:>8}" + ''.join([f'{result[c]:>14.4f}' if result.get(c,None) is not None else f'{"-":>14}' for c in columns]),flush=True)
+    finally:
+        if args.work_dir is None: shutil.rmtree(work_dir,ignore_errors=True)
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
 from .mbatch import *
 
-from . import _version
-__version__ = _version.get_versions()['version']
+def __getattr__(name):
+    # Finding the version can call git, so only do it when asked
+    if name=='__version__':
+        from . import _version
+        return _version.get_versions()['version']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,351 @@
+import os,sys,json,time,re,signal,threading,subprocess
+from .mbatch import TERMINAL_STATES,DEFAULT_MAX_ARRAY_SIZE,get_cache_dir,get_machine_memory_gb,parse_walltime,raise_exception,fprint,HTML
+
+"""
+A local emulator of SLURM, so that pipelines can be run with
+mbatch --emulate on a workstation, and so that submission and reuse
+can be tested and benchmarked without a cluster.
+
+EmulatorBackend takes the place of sbatch and sacct (see SlurmBackend
+in mbatch.py). Submitted batch scripts wait for their
+--dependency=afterok jobs and are then run with bash, as many at a time
+as fit in the cores of this machine. The cores a job needs are read
+from the #SBATCH lines of its script (--nodes, --ntasks-per-node and
+--cpus-per-task), and jobs that run over their --time are killed.
+
+There is no daemon: jobs only run while the mbatch process that
+submitted them does, so mbatch waits for them before exiting. Their
+states are saved in emulator_jobs.json in the mbatch cache directory
+(see get_cache_dir() in mbatch.py), so later invocations of mbatch can
+query them like they would with sacct.
+Jobs that were left unfinished by a process that is no longer running
+are reported as CANCELLED.
+
+Batch scripts run with a srun on the PATH that runs its command once,
+or through mpirun if the job has more than one task and mpirun exists.
+"""
+
+SRUN = '''#!/bin/bash
+# srun of the mbatch SLURM emulator
+# Options other than --ntasks=N are ignored, and need to be given as --option=value
+ntasks="${SLURM_NTASKS:-1}"
+while [[ "$1" == -* ]]; do
+    case "$1" in --ntasks=*) ntasks="${1#--ntasks=}";; esac
+    shift
+done
+if [[ "$ntasks" -gt 1 ]] && command -v mpirun > /dev/null; then
+    exec mpirun -np "$ntasks" "$@"
+fi
+exec "$@"
+'''
+
+TEMPLATE = '''#!/bin/bash!CONSTRAINT!QOS!PARTITION!ACCOUNT
+#SBATCH --nodes=!NODES
+#SBATCH --time=!WALL
+#SBATCH --ntasks-per-node=!TASKSPERNODE
+#SBATCH --cpus-per-task=!THREADS
+#SBATCH --job-name=!JOBNAME
+#SBATCH --output=!OUT_%j.txt
+
+cd $SLURM_SUBMIT_DIR
+export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+!EXTRA
+srun !CMD
+'''
+
+def get_state_filename():
+    return os.path.join(get_cache_dir(),'emulator_jobs.json')
+
+def parse_array(array):
+    '''Returns the task IDs and the limit on simultaneous tasks of e.g. 0-9%2 or 1,3,5'''
+    limit = None
+    if '%' in array:
+        array,limit = array.split('%')
+        limit = int(limit)
+    tasks = []
+    for part in array.split(','):
+        if '-' in part:
+            start,end = part.split('-')
+            tasks += list(range(int(start),int(end)+1))
+        else:
+            tasks.append(int(part))
+    return tasks,limit
+
+def parse_directives(fname):
+    '''Returns the options in the #SBATCH lines of a batch script'''
+    directives = {}
+    with open(fname,'r') as f:
+        for line in f:
+            m = re.match(r'#SBATCH\s+--([\w-]+)(?:=(\S+))?',line)
+            if m is not None: directives[m.group(1)] = m.group(2)
+    return directives
+
+def is_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class EmulatorBackend(object):
+    '''Runs SLURM batch scripts on this machine (see the top of this module)'''
+    name = 'emulator'
+
+    def __init__(self,ncores=None,poll_interval=0.05):
+        self.ncores = ncores if ncores is not None else (os.cpu_count() or 1)
+        self.poll_interval = poll_interval
+        self.jobs = {} # jobs submitted by this process, in order of submission
+        self.arrays = {} # job IDs of the tasks of each job array
+        self.running = {} # jobid -> (process, start time, output file)
+        self.used_cores = 0
+        self.changed = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.shim_dir = os.path.join(get_cache_dir(),'emulator_bin')
+        os.makedirs(self.shim_dir, exist_ok=True)
+        srun = os.path.join(self.shim_dir,'srun')
+        with open(srun+f'.{os.getpid()}.tmp','w') as f:
+            f.write(SRUN)
+        os.chmod(srun+f'.{os.getpid()}.tmp',0o755)
+        os.replace(srun+f'.{os.getpid()}.tmp',srun)
+
+    def get_site_config(self):
+        '''A site configuration (see data/sites) that describes this machine as a single node'''
+        memory_gb = get_machine_memory_gb()
+        if memory_gb is None: memory_gb = 4. * self.ncores
+        return {'default_constraint': 'None', 'default_part': 'None',
+                'default_qos': 'None', 'default_account': 'None',
+                'architecture': {'None': {'None': {'cores_per_node': self.ncores,
+                                                   'memory_per_node_gb': memory_gb,
+                                                   'threads_per_core': 1}}},
+                'template': TEMPLATE}
+
+    def _locked(self,func):
+        # The files in the cache directory are shared by all processes using the emulator
+        import fcntl
+        fname = get_state_filename()
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname+'.lock','w') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            return func(fname)
+
+    def _new_jobid(self):
+        def _increment(fname):
+            try:
+                with open(fname+'.jobid','r') as f:
+                    jobid = int(f.read()) + 1
+            except (OSError,ValueError):
+                jobid = 1
+            with open(fname+'.jobid','w') as f:
+                f.write(str(jobid))
+            return str(jobid)
+        return self._locked(_increment)
+
+    def _update_state_file(self):
+        '''Saves the states of the jobs of this process, merging them into those of others'''
+        def _update(fname):
+            try:
+                with open(fname,'r') as f:
+                    state = json.load(f)
+            except (OSError,ValueError):
+                state = {'jobs': {}}
+            for jobid,job in self.jobs.items():
+                state['jobs'][jobid] = {'state': job['state'], 'owner': os.getpid(), 'name': job['name'],
+                                        'array_job_id': job['array_job_id']}
+            with open(fname+'.tmp','w') as f:
+                json.dump(state,f)
+            os.replace(fname+'.tmp',fname)
+        self._locked(_update)
+
+    def _load_states(self):
+        try:
+            with open(get_state_filename(),'r') as f:
+                return json.load(f)['jobs']
+        except (OSError,ValueError):
+            return {}
+
+    def get_job_states(self,jobids):
+        '''Returns the states of jobs like get_job_states() in mbatch.py
+
+        Like sacct, this gives the states of the tasks of a job array
+        when asked about the job array.
+        '''
+        saved = None
+        saved_arrays = None
+        states = {}
+        for jobid in jobids:
+            jobid = str(jobid)
+            with self.lock:
+                job = self.jobs.get(jobid,None)
+                if job is not None:
+                    states[jobid] = job['state']
+                    continue
+                if jobid in self.arrays:
+                    for task_jobid in self.arrays[jobid]: states[task_jobid] = self.jobs[task_jobid]['state']
+                    continue
+            if saved is None:
+                saved = self._load_states()
+                saved_arrays = {}
+                for task_jobid,job in saved.items():
+                    if job.get('array_job_id',None) is not None: saved_arrays.setdefault(job['array_job_id'],[]).append(task_jobid)
+            for task_jobid in saved_arrays.get(jobid,[jobid]):
+                if not(task_jobid in saved): continue
+                state = saved[task_jobid]['state']
+                # Nothing will run this job any more
+                if not(state in TERMINAL_STATES) and not(is_alive(saved[task_jobid]['owner'])): state = 'CANCELLED'
+                states[task_jobid] = state
+        return states
+
+    def get_max_array_size(self):
+        # Like a cluster with the default SLURM configuration
+        return DEFAULT_MAX_ARRAY_SIZE
+
+    def submit(self,fname,depstr=None,array=None,dry_run=False):
+        '''Queues a batch script like sbatch --parsable and returns its job ID'''
+        print(f"Emulating sbatch {'--dependency='+depstr.split('=')[-1]+' ' if depstr else ''}{'--array='+array+' ' if array else ''}{fname}")
+        if dry_run:
+            import random
+            return str(random.randint(1,32768))
+        directives = parse_directives(fname)
+        if depstr is not None:
+            if not(depstr.startswith('--dependency=afterok:')): raise_exception(f"The SLURM emulator only supports afterok dependencies, not {depstr}.")
+            deps = depstr[len('--dependency=afterok:'):].split(':')
+        else:
+            deps = []
+        deps_tasks = []
+        for dep in deps:
+            # Depending on a job array means depending on all of its tasks
+            deps_tasks += self.arrays.get(dep,[dep])
+        known = self.get_job_states(deps_tasks)
+        unknown = [d for d in deps_tasks if not(d in known)]
+        if len(unknown)>0: raise_exception(f"The SLURM emulator does not know the jobs {unknown} that {fname} depends on.")
+        nodes = int(directives.get('nodes',None) or 1)
+        ntasks = int(directives.get('ntasks',None) or nodes*int(directives.get('ntasks-per-node',None) or 1))
+        cpus_per_task = int(directives.get('cpus-per-task',None) or 1)
+        cores = ntasks * cpus_per_task
+        if cores>self.ncores:
+            fprint(HTML(f"<ansiyellow>WARNING: {fname} asks for {cores} cores but there are only {self.ncores}. It will run alone on all of them.</ansiyellow>"))
+            cores = self.ncores
+        jobid = self._new_jobid()
+        # Like sbatch, jobs run in the environment they were submitted from
+        job = {'name': directives.get('job-name',None) or os.path.basename(fname),
+               'script': os.path.abspath(fname), 'submit_dir': os.getcwd(), 'env': dict(os.environ),
+               'output': directives.get('output',None) or os.path.join(os.getcwd(),'slurm-%j.out'),
+               'deps': deps_tasks, 'cores': cores, 'ntasks': ntasks, 'cpus_per_task': cpus_per_task,
+               'time_limit': parse_walltime(directives.get('time',None) or '0'),
+               'state': 'PENDING', 'array_job_id': None, 'array_task_id': None, 'array_limit': None}
+        with self.lock:
+            if array is None:
+                self.jobs[jobid] = job
+            else:
+                tasks,limit = parse_array(array)
+                self.arrays[jobid] = []
+                for task in tasks:
+                    task_jobid = f'{jobid}_{task}'
+                    self.jobs[task_jobid] = dict(job,array_job_id=jobid,array_task_id=task,array_limit=limit)
+                    self.arrays[jobid].append(task_jobid)
+            self.changed = True
+            if (self.thread is None) or not(self.thread.is_alive()):
+                self.thread = threading.Thread(target=self._schedule,daemon=True)
+                self.thread.start()
+        return jobid
+
+    def _launch(self,jobid,job):
+        env = dict(job['env'])
+        env['PATH'] = self.shim_dir + os.pathsep + env.get('PATH','')
+        env['SLURM_JOB_ID'] = jobid
+        env['SLURM_JOB_NAME'] = job['name']
+        env['SLURM_SUBMIT_DIR'] = job['submit_dir']
+        env['SLURM_NTASKS'] = str(job['ntasks'])
+        env['SLURM_CPUS_PER_TASK'] = str(job['cpus_per_task'])
+        env['SLURM_JOB_NUM_NODES'] = '1'
+        env['SLURM_NNODES'] = '1'
+        output = job['output'].replace('%j',jobid)
+        if job['array_job_id'] is not None:
+            env['SLURM_ARRAY_JOB_ID'] = job['array_job_id']
+            env['SLURM_ARRAY_TASK_ID'] = str(job['array_task_id'])
+            output = output.replace('%A',job['array_job_id']).replace('%a',str(job['array_task_id']))
+        out = open(output,'w')
+        process = subprocess.Popen(['bash',job['script']],stdout=out,stderr=subprocess.STDOUT,
+                                   cwd=job['submit_dir'],env=env,start_new_session=True)
+        job['state'] = 'RUNNING'
+        self.running[jobid] = (process,time.monotonic(),out)
+        self.used_cores += job['cores']
+
+    def _finish(self,jobid,state):
+        process,start,out = self.running.pop(jobid)
+        out.close()
+        self.jobs[jobid]['state'] = state
+        self.used_cores -= self.jobs[jobid]['cores']
+        self.changed = True
+
+    def _schedule(self):
+        '''Runs queued jobs as their dependencies complete and cores free up, until none are left'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                for jobid,(process,start,out) in list(self.running.items()):
+                    ret = process.poll()
+                    if ret is not None:
+                        self._finish(jobid,'COMPLETED' if ret==0 else 'FAILED')
+                    elif (self.jobs[jobid]['time_limit'] is not None) and (now-start>self.jobs[jobid]['time_limit']):
+                        os.killpg(process.pid,signal.SIGKILL)
+                        process.wait()
+                        self._finish(jobid,'TIMEOUT')
+                pending = [(jobid,job) for jobid,job in self.jobs.items() if job['state']=='PENDING']
+                running_tasks = {}
+                for jobid in self.running:
+                    array_job_id = self.jobs[jobid]['array_job_id']
+                    running_tasks[array_job_id] = running_tasks.get(array_job_id,0) + 1
+                saved = None
+                for jobid,job in pending:
+                    states = []
+                    for dep in job['deps']:
+                        if dep in self.jobs:
+                            states.append(self.jobs[dep]['state'])
+                        else:
+                            if saved is None: saved = self._load_states()
+                            states.append(saved.get(dep,{}).get('state','CANCELLED'))
+                    # SLURM would leave these pending forever
+                    if any([(s in TERMINAL_STATES) and s!='COMPLETED' for s in states]):
+                        job['state'] = 'CANCELLED'
+                        self.changed = True
+                        continue
+                    if not(all([s=='COMPLETED' for s in states])): continue
+                    if (self.used_cores + job['cores'] > self.ncores) and (len(self.running)>0): continue
+                    if (job['array_limit'] is not None) and (running_tasks.get(job['array_job_id'],0)>=job['array_limit']): continue
+                    self._launch(jobid,job)
+                    running_tasks[job['array_job_id']] = running_tasks.get(job['array_job_id'],0) + 1
+                    self.changed = True
+                if self.changed:
+                    self._update_state_file()
+                    self.changed = False
+                if len(self.running)==0 and not(any([job['state']=='PENDING' for job in self.jobs.values()])): return
+            time.sleep(self.poll_interval)
+
+    def wait(self):
+        '''Waits for all the jobs submitted by this process'''
+        if (self.thread is None) or not(self.thread.is_alive()): return self._summary()
+        print(f"Waiting for the {len(self.jobs)} emulated jobs to finish...")
+        try:
+            while self.thread.is_alive():
+                self.thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            with self.lock:
+                for jobid,(process,start,out) in list(self.running.items()):
+                    os.killpg(process.pid,signal.SIGKILL)
+                    process.wait()
+                    self._finish(jobid,'CANCELLED')
+                for job in self.jobs.values():
+                    if job['state']=='PENDING': job['state'] = 'CANCELLED'
+                self._update_state_file()
+            raise
+        self._summary()
+
+    def _summary(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job['state']] = counts.get(job['state'],0) + 1
+        if len(counts)>0: print("Emulated jobs: " + ', '.join([f'{v} {k}' for k,v in counts.items()]))
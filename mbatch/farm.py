@@ -0,0 +1,150 @@
+import os,sys,json,subprocess
+import argparse
+from .mbatch import iter_array,SWEEP_LABEL
+
+"""
+An MPI task farm for the iterations of a looped stage with farm: true.
+
+Instead of a job (or job array task) for each iteration, mbatch submits
+one MPI job that runs
+
+python -m mbatch.farm TASKS_FILE
+
+on each of its ranks, where TASKS_FILE is a JSON list of iterations
+written by mbatch, each with
+cmds      the command of the iteration, as a list
+out_file  where its output goes, as {out_file}_{jobid}.txt
+marker    written as {marker}_{jobid}.txt once it succeeds (see get_slurm_state_file())
+
+For a sweep, TASKS_FILE instead has the command shared by its points,
+the options and labels of the values of its lists, and the indices of
+the points to run (see SweepTasks), and the points are only made as
+they are handed out. The indices of those that fail are then written
+to {failed_file}_{jobid}.json, for mbatch to run only those again.
+
+Rank 0 hands out the iterations one at a time to the other ranks as
+they become free, so a stage with nproc=N runs N-1 iterations at a time
+(or all of them one after another on rank 0 if N=1). Iterations that
+fail don't stop the others, but make the job fail. Iterations whose
+marker was already written by this job (e.g. it was requeued) are
+skipped, and mbatch doesn't put those that completed in an earlier job
+in the tasks file.
+
+This needs mpi4py.
+"""
+
+# Message tags
+TAG_READY = 1 # a worker asking for an iteration, with the result of its last one
+TAG_TASK = 2 # the master sending an iteration, or None to stop
+
+class SweepTasks(object):
+    '''The points of a sweep that a farm runs, made like tasks of a loop when asked for'''
+    def __init__(self,spec):
+        self.spec = spec
+        self.indices = list(iter_array(spec['indices']))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self,i):
+        spec = self.spec
+        k = self.indices[i]
+        # Like Sweep.coords() in mbatch.py
+        if spec['strides'] is None: coords = [k]*len(spec['sizes'])
+        else: coords = [(k//stride)%size for stride,size in zip(spec['strides'],spec['sizes'])]
+        label = '_'.join([labels[c] for labels,c in zip(spec['labels'],coords)])
+        output_dir = spec['output_dir'].replace(SWEEP_LABEL,label)
+        options = [w for values,c in zip(spec['options'],coords) for w in values[c]]
+        return {'stage': f"{spec['stage']}_{label}",
+                'cmds': spec['cmds'] + options + ['--output-dir',output_dir],
+                'out_file': spec['out_file'].replace(SWEEP_LABEL,label),
+                'marker': spec['marker'].replace(SWEEP_LABEL,label)}
+
+def get_marker(task,jobid):
+    return f"{task['marker']}_{jobid}.txt"
+
+def run_task(task,jobid):
+    '''Runs one iteration and records whether it completed'''
+    # The points of a sweep make their output directories when they run
+    os.makedirs(os.path.dirname(task['out_file']),exist_ok=True)
+    with open(f"{task['out_file']}_{jobid}.txt",'w') as f:
+        try:
+            returncode = subprocess.run(task['cmds'],stdout=f,stderr=subprocess.STDOUT).returncode
+        except OSError as e:
+            f.write(f'{e}\n')
+            returncode = 127
+    if returncode==0:
+        with open(get_marker(task,jobid),'w') as f:
+            f.write('COMPLETED')
+    return returncode
+
+def master(comm,tasks,jobid):
+    '''Hands out iterations to the other ranks and returns those that failed'''
+    from mpi4py import MPI
+    todo = [i for i,task in enumerate(tasks) if not(os.path.exists(get_marker(task,jobid)))]
+    if len(todo)<len(tasks): print(f"Skipping {len(tasks)-len(todo)} iterations that already completed.")
+    print(f"Running {len(todo)} iterations on {max(comm.Get_size()-1,1)} rank(s)...",flush=True)
+    failed = []
+    def _done(i,returncode):
+        if returncode!=0:
+            failed.append(i)
+            print(f"{tasks[i]['stage']} failed with exit code {returncode}.",flush=True)
+
+    if comm.Get_size()==1:
+        for i in todo: _done(i,run_task(tasks[i],jobid))
+        return failed
+
+    todo.reverse() # so that pop() hands them out in order
+    nworkers = comm.Get_size()-1
+    status = MPI.Status()
+    while nworkers>0:
+        result = comm.recv(source=MPI.ANY_SOURCE,tag=TAG_READY,status=status)
+        if result is not None: _done(*result)
+        if len(todo)>0:
+            comm.send(todo.pop(),dest=status.Get_source(),tag=TAG_TASK)
+        else:
+            comm.send(None,dest=status.Get_source(),tag=TAG_TASK)
+            nworkers -= 1
+    return failed
+
+def worker(comm,tasks,jobid):
+    result = None
+    while True:
+        comm.send(result,dest=0,tag=TAG_READY)
+        i = comm.recv(source=0,tag=TAG_TASK)
+        if i is None: break
+        result = (i,run_task(tasks[i],jobid))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the iterations of a looped stage as an MPI task farm.')
+    parser.add_argument("tasks_file", type=str,help='JSON file with the iterations, written by mbatch.')
+    parser.add_argument("--output-dir", type=str, default=None,help="Output directory of the looped stage (unused, but passed by mbatch as to any stage).")
+    parser.add_argument("--jobid", type=str, default=None,help="Job ID to name the output and marker files with. Defaults to $SLURM_JOB_ID.")
+    args = parser.parse_args()
+
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        print("A farm needs mpi4py. Install it with pip install mpi4py.",file=sys.stderr)
+        sys.exit(1)
+    comm = MPI.COMM_WORLD
+    jobid = args.jobid if args.jobid is not None else os.environ.get('SLURM_JOB_ID','local')
+    with open(args.tasks_file,'r') as f:
+        tasks = json.load(f)
+    if isinstance(tasks,dict): tasks = SweepTasks(tasks)
+
+    if comm.Get_rank()==0:
+        failed = master(comm,tasks,jobid)
+        if len(failed)>0: print(f"{len(failed)} of {len(tasks)} iterations failed.",flush=True)
+        else: print("All iterations completed.",flush=True)
+        if isinstance(tasks,SweepTasks):
+            with open(f"{tasks.spec['failed_file']}_{jobid}.json",'w') as f:
+                json.dump(sorted([tasks.indices[i] for i in failed]),f)
+    else:
+        worker(comm,tasks,jobid)
+        failed = None
+    failed = comm.bcast(failed,root=0)
+    if len(failed)>0: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
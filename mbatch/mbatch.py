@@ -1,10 +1,17 @@
-import os,sys,shutil,subprocess,warnings,glob,re,shlex,copy
-import argunparse,yaml,math,time
-from prompt_toolkit import print_formatted_text as fprint, HTML, prompt
-import random
-from pathlib import Path
-from pprint import pprint
+import os,sys,subprocess,glob,re,shlex,json,hashlib,threading,math,time,functools,codecs
 import argparse
+# Other dependencies (prompt_toolkit, yaml, argunparse, git, ...) are only
+# imported where they are needed, since importing them takes a noticeable
+# fraction of a second on slow login nodes and most invocations of mbatch
+# or wmpi only need a few of them
+
+def fprint(*args,**kwargs):
+    from prompt_toolkit import print_formatted_text
+    return print_formatted_text(*args,**kwargs)
+
+def HTML(value):
+    from prompt_toolkit import HTML
+    return HTML(value)
 
 """
 Files produced:
@@ -12,10 +19,31 @@ e.g. project foo, stages bar1, bar2
 
 # SLURM
 foo
+  mbatch_index.json # index of the last submission of each stage, used to decide reuse
+  mbatch_profile.json # time spent in each phase of the last run with --profile
   bar1
      slurm_out_{stage}_{project}_{site}_{slurm)_{jobid}.txt # SLURM output, used to extract job id
+     slurm_state_{stage}_{project}_{jobid}.txt # written once the stage succeeds, when it shares its job with other stages
      stage_config_{jobid}.yml # config file, contains time as well
 
+# SLURM job array (looped stage bar3 iterated over a1, a2)
+foo
+  bar3
+     slurm_submission_{project}_{bar3}_{site}_{time}.sh # single batch script for all iterations (one per array if they need several)
+     array_tasks_{bar3}_{project}_{time}.txt # argument, output directory and SLURM output file of each iteration
+  bar3_a1
+     slurm_out_{stage}_{project}_{site}_{arrayjobid}_{taskid}.txt # SLURM output of this iteration
+     stage_config_{arrayjobid}_{taskid}.yml
+
+# SLURM job array of a sweep (stage bar4 with a sweep over lmax: [1000, 2000])
+foo
+  bar4
+     slurm_submission_{project}_{bar4}_{site}_{time}.sh # batch script that works out the point of each task
+     sweep_values_{bar4}_{project}_{time}.txt # options and label of each value in the sweep
+     stage_config_{arrayjobid}.yml # one for the whole sweep
+  bar4_lmax1000
+     slurm_out_{stage}_{project}_{site}_{arrayjobid}_{taskid}.txt # SLURM output of this point
+
 # LOCAL
 foo
   bar1
@@ -65,28 +93,231 @@ def sint(x):
     if x.strip()=='': return 0
     return int(x)
 
+def jobid_key(jobid):
+    # Sort key for job IDs, including array task IDs like 1234_5
+    return tuple(sint(x) for x in str(jobid).split('_'))
+
 def check_slurm():
-    try:
-        ret = subprocess.run(["sbatch","-V"])
-        return True
-    except FileNotFoundError:
-        return False
+    import shutil
+    return shutil.which("sbatch") is not None
 
-def gitcheck(config,cname,package):
+def gitcheck(config,cname,package,max_workers=8):
     try:
         gitchecks = config[cname]
     except:
         gitchecks = []
+    if gitchecks is None: gitchecks = []
+    # Each check is dominated by filesystem and git subprocess work, so
+    # we run them concurrently and collect the results in the listed order
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,min(max_workers,len(gitchecks)))) as pool:
+        futures = [pool.submit(get_info,package=pkg if package else None,
+                               path=pkg if not(package) else None,
+                               validate=True) for pkg in gitchecks]
     odict = {}
-    for pkg in gitchecks:
+    for pkg,future in zip(gitchecks,futures):
         #TODO: do something more with ginfo
-        ginfo = get_info(package=pkg if package else None,
-                                path=pkg if not(package) else None,
-                                validate=True)
-        odict[pkg] = ginfo
+        odict[pkg] = future.result()
     return odict
 
-def get_command(global_vals, stage_configs, stage):
+class Sweep(object):
+    '''The points of the sweep block of a stage
+
+    A sweep block has either a product or a zip of lists of values of
+    options, e.g.
+    sweep:
+      product:
+        lmax: [1000, 2000]
+        seed: [0, 1, 2]
+    gives the 6 points (lmax=1000,seed=0), (lmax=1000,seed=1), ... and
+    zip would instead give (lmax=1000,seed=0), (lmax=2000,seed=1), which
+    needs lists of the same length. Points are only made when asked for,
+    by index or by iterating, so a sweep only stores its lists. Point k
+    of a product has the value (k//strides[j])%len(values[j]) of the
+    j-th list, and point k of a zip the k-th value of each list.
+    '''
+    __slots__ = ('spec','names','values','mode','strides','size')
+
+    def __init__(self,sweep,stage):
+        if not(isinstance(sweep,dict)) or (len(sweep)!=1) or not(list(sweep.keys())[0] in ['product','zip']):
+            raise_exception(f"The sweep of {stage} should have either product or zip (and nothing else).")
+        self.spec = sweep
+        self.mode,options = list(sweep.items())[0]
+        if not(isinstance(options,dict)) or len(options)==0: raise_exception(f"The sweep of {stage} has no options.")
+        self.names = list(options.keys())
+        self.values = []
+        for name,values in options.items():
+            if not(isinstance(values,(list,tuple))) or len(values)==0:
+                raise_exception(f"{name} in the sweep of {stage} should be a non-empty list.")
+            if len(set([str(v) for v in values]))!=len(values):
+                raise_exception(f"{name} in the sweep of {stage} has repeated values.")
+            for v in values:
+                # Values end up in the names (and output directories) of the points
+                if isinstance(v,(list,dict)) or not(re.fullmatch(r'[\w.+-]+',str(v))):
+                    raise_exception(f"{v!r} of {name} in the sweep of {stage} should be a number or a word.")
+            self.values.append(list(values))
+        if self.mode=='zip':
+            if len(set([len(v) for v in self.values]))!=1: raise_exception(f"The lists zipped in the sweep of {stage} should have the same length.")
+            self.size = len(self.values[0])
+        else:
+            self.strides = []
+            self.size = 1
+            for values in reversed(self.values):
+                self.strides.insert(0,self.size)
+                self.size *= len(values)
+
+    def __len__(self):
+        return self.size
+
+    def coords(self,k):
+        '''Positions of the values of the k-th point in each list'''
+        if self.mode=='zip': return [k]*len(self.names)
+        return [(k//stride)%len(values) for values,stride in zip(self.values,self.strides)]
+
+    def __getitem__(self,k):
+        '''The option values of the k-th point'''
+        return {name: values[i] for name,values,i in zip(self.names,self.values,self.coords(k))}
+
+    def __iter__(self):
+        import itertools
+        points = zip(*self.values) if self.mode=='zip' else itertools.product(*self.values)
+        for point in points:
+            yield dict(zip(self.names,point))
+
+    def get_label(self,k):
+        '''Label of the k-th point, e.g. lmax1000_seed0'''
+        return '_'.join([f'{name}{v}' for name,v in self[k].items()])
+
+    def iter_labels(self):
+        '''Labels of the points, in order'''
+        import itertools
+        labels = [[f'{name}{v}' for v in values] for name,values in zip(self.names,self.values)]
+        points = zip(*labels) if self.mode=='zip' else itertools.product(*labels)
+        for point in points:
+            yield '_'.join(point)
+
+class Stage(object):
+    '''A stage of the unrolled pipeline
+
+    This behaves like a read-only view of the stage's configuration
+    dict. Iterations of a looped stage share the configuration dict of
+    their parent and only store their own positional argument, so that
+    unrolling large loops does not copy the configuration. A stage with
+    a sweep is not unrolled at all: it stays one stage with its Sweep,
+    whose options leave out those that the points set.
+    '''
+    __slots__ = ('config','parent','arg','sweep')
+
+    def __init__(self,config,parent=None,arg=None,sweep=None):
+        self.config = config
+        self.parent = parent # Name of the looped stage this iterates, if any
+        self.arg = arg
+        self.sweep = sweep
+
+    def __getitem__(self,key):
+        if (key=='options') and (self.sweep is not None):
+            return {k:v for k,v in (self.config.get('options',None) or {}).items() if not(k in self.sweep.names)}
+        elif key=='arg' and self.parent is not None: return self.arg
+        return self.config[key]
+
+    def __contains__(self,key):
+        return key in self.config
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        '''Returns a (shallow) dict of the configuration of this stage'''
+        odict = dict(self.config)
+        if self.parent is not None: odict['arg'] = self.arg
+        return odict
+
+    def __repr__(self):
+        return f'Stage({self.to_dict()!r})'
+
+_maybe_split = re.compile(r'[\s\'"\\]')
+
+def unroll_stages(cstages):
+    '''Unrolls looped stages, i.e. those whose arg is a list
+
+    Returns a dict mapping stage names to Stage objects, and a dict
+    mapping each looped stage name to the list of its unrolled
+    iterated stage names. Sweeps are kept as one stage (see Stage), and
+    their points are only named (e.g. stage_lmax1000_seed0, which is
+    also their output directory) when they are run.
+    '''
+    ostages = {} # Unrolled stage dictionary
+    unroll_map = {} # dict mapping parent stage name to list of unrolled iterated stage names
+    for stage,config in cstages.items():
+        if ('sweep' in config):
+            if isinstance(config.get('arg',None),(list,tuple)): raise_exception(f"{stage} can't both loop over arg and have a sweep.")
+            sweep = Sweep(config['sweep'],stage)
+            for name in sweep.names:
+                if name in config.get('globals',[]): raise_exception(f"{name} in the sweep of {stage} is also one of its globals.")
+            # The output directories of the points would clash with those of other stages
+            prefix = f'{stage}_{sweep.names[0]}'
+            for other in cstages:
+                if other.startswith(prefix):
+                    raise_exception(f"Stage name {other} clashes with the points of the sweep of {stage}. "
+                                    "Please use a different stage name.")
+            ostages[stage] = Stage(config,sweep=sweep)
+        # Check if this is a looped stage
+        elif ('arg' in config):
+            if (type(config['arg'])) in [list,tuple]:
+                unroll_map[stage] = []
+                for k,arg in enumerate(config['arg']):
+                    # shlex is slow, so we only use it when the argument could split
+                    if _maybe_split.search(arg) and len(shlex.split(arg))>1: raise Exception("Argument should not be interpretable as multiple arguments.")
+                    new_stage_name = f'{stage}_{arg}'
+                    if new_stage_name in cstages:
+                        raise_exception(f"Internal loop stage name "
+                                        "clashes with {stage}_!loop_iteration_{k}. "
+                                        "Please use a different stage name.")
+                    ostages[new_stage_name] = Stage(config,parent=stage,arg=arg)
+                    unroll_map[stage].append(new_stage_name)
+            else:
+                if len(shlex.split(config['arg']))>1: raise Exception("Argument should not be interpretable as multiple arguments.")
+                ostages[stage] = Stage(config)
+        else:
+            ostages[stage] = Stage(config)
+    return ostages, unroll_map
+
+def map_dependencies(ostages, unroll_map):
+    '''Maps each unrolled stage to the list of unrolled stages it depends on
+
+    Returns that dict and the set of stages that are depended on.
+    Iterations of the same looped stage share a single list.
+    '''
+    deps = {} # Mapping from stage to its dependencies
+    depended = set() # Set of stages that are depended on
+    loop_deps = {} # Mapping from looped stage to the dependencies shared by its iterations
+    for sname,ostage in ostages.items():
+        if ostage.parent in loop_deps:
+            deps[sname] = loop_deps[ostage.parent]
+            continue
+        ds = ostage.get('depends')
+        if ds is None: continue
+        my_deps = []
+        for d in ds:
+            if not(d in ostages) and not(d in unroll_map):
+                raise_exception(f"Stage {d} required by {sname} not found in configuration file.")
+            if d in unroll_map:
+                my_deps.extend(unroll_map[d])
+            else:
+                my_deps.append(d)
+        depended.update(my_deps)
+        deps[sname] = my_deps
+        if ostage.parent is not None: loop_deps[ostage.parent] = my_deps
+    return deps, depended
+
+# Stand-in for the positional argument when rendering the command of a job array
+ARRAY_ARG = 'MBATCH_ARRAY_ARG'
+
+def get_command(global_vals, stage_configs, stage, arg=None):
+    # arg, if given, replaces the positional argument of the stage
     stage_config = stage_configs[stage]
     execution = stage_config['exec']
     if not(execution in ['python','python3','python -u']):
@@ -96,17 +327,20 @@ def get_command(global_vals, stage_configs, stage):
                         "added soon.")
     script_name = stage_config['script']
     global_opts = stage_config.get('globals',[])
-    arg = stage_config.get('arg','')
+    if arg is None: arg = stage_config.get('arg','')
     if not(isinstance(arg,str)): raise_exception(f"arg should be a string. {artg} in {stage} does not satisfy this.")
     arg = [arg] if arg!='' else []
-    options = stage_config.get('options',{})
-    optkeys = list(options.keys())
+    # Stage configs are shared and must not be modified, so we
+    # only copy the options that are rendered for this stage
+    options = dict(stage_config.get('options',{}))
     for global_opt in global_opts:
-        if global_opt in optkeys:
+        if global_opt in options:
+            from pprint import pprint
             pprint(stage_configs[stage])
             pprint(stage)
             raise_exception(f"{global_opt} in {stage} config is already a global.")
         options[global_opt] = global_vals[global_opt]
+    import argunparse
     unparser = argunparse.ArgumentUnparser()
     unparsed = unparser.unparse(*arg, **options)
     if unparsed=='\"\"' or unparsed=='\'\'': unparsed = ''
@@ -114,15 +348,86 @@ def get_command(global_vals, stage_configs, stage):
     #from an external library
     return execution,script_name,unparsed
 
-def run_local(cmds,dry_run=False,verbose=True):
+# Serializes lines echoed by stages running at the same time
+_echo_lock = threading.Lock()
+
+def stream_local(cmds,log_file,echo=True,prefix='',tail_lines=20,max_line=65536,env=None):
+    '''Runs a command, streaming its stdout and stderr line by line
+
+    Both are appended to log_file as they arrive and, if echo, copied to
+    our own stdout and stderr (each line starting with prefix). Only the
+    last tail_lines lines are kept in memory, and reads are capped at
+    max_line bytes, so a stage can print as much as it likes. Returns the exit
+    code and those last lines.
+    '''
+    import collections
+    tail = collections.deque(maxlen=tail_lines)
+    lock = threading.Lock()
+    with open(log_file,'ab') as log:
+        sp = subprocess.Popen(cmds,stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env)
+        def _pump(pipe,out):
+            # Lines longer than max_line come through in several chunks, so
+            # only put the prefix where a line actually starts and don't add
+            # newlines the stage didn't print (except one at EOF if missing).
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            at_start = True
+            for line in iter(lambda: pipe.readline(max_line), b''):
+                with lock:
+                    log.write(line)
+                    log.flush()
+                    tail.append(line)
+                if echo:
+                    text = decoder.decode(line)
+                    if text=='': continue
+                    with _echo_lock:
+                        out.write(prefix+text if at_start else text)
+                        out.flush()
+                    at_start = text.endswith('\n')
+            if echo:
+                text = decoder.decode(b'',final=True)
+                if not(at_start) or text!='':
+                    with _echo_lock:
+                        out.write((text if not(at_start) else prefix+text)+'\n')
+                        out.flush()
+            pipe.close()
+        pumps = [threading.Thread(target=_pump,args=(sp.stdout,sys.stdout),daemon=True),
+                 threading.Thread(target=_pump,args=(sp.stderr,sys.stderr),daemon=True)]
+        for t in pumps: t.start()
+        for t in pumps: t.join()
+        returncode = sp.wait()
+    # Chunks of a long line are glued back together before picking the last lines
+    lines = b''.join(tail).decode('utf-8',errors='replace').splitlines()
+    return returncode,lines[-tail_lines:]
+
+def run_local(cmds,dry_run=False,verbose=True,log_file=None,echo=True,prefix='',env=None):
+    '''Runs a command locally
+
+    Without log_file, its stdout is returned once it has exited. With
+    log_file, its output is streamed there instead (see stream_local) and
+    nothing is returned. env has environment variables to set for the
+    command on top of ours.
+    '''
     icmds = [c.strip() for c in cmds]
     cmds = []
     for c in icmds:
         cmds = cmds + shlex.split(c)
-    if verbose: print(f"Running {cmds} locally...")
+    env = env or {}
+    if verbose:
+        # Stages run at the same time, so this shouldn't land in the middle of their output
+        with _echo_lock:
+            print(f"Running {cmds} locally...",flush=True)
     if dry_run:
-        if verbose: print(' '.join(cmds))
+        if verbose: print(' '.join([f'{k}={v}' for k,v in env.items()]+cmds))
+        import random
         return str(random.randint(1,32768))
+    elif log_file is not None:
+        returncode,tail = stream_local(cmds,log_file,echo=echo and verbose,prefix=prefix,
+                                       env=dict(os.environ,**env) if len(env)>0 else None)
+        if returncode!=0:
+            if not(echo and verbose):
+                with _echo_lock:
+                    print('\n'.join(tail),file=sys.stderr,flush=True)
+            raise_exception(f"Command returned non-zero exit code {returncode}. See {log_file}.")
     else:
         sp = subprocess.run(cmds,stderr=sys.stderr, stdout=subprocess.PIPE)
         output = sp.stdout.decode("utf-8")
@@ -130,6 +435,441 @@ def run_local(cmds,dry_run=False,verbose=True):
         if sp.returncode!=0: raise_exception("Command returned non-zero exit code. See earlier error messages.")
         return output
 
+# SLURM job states that never change once reached
+TERMINAL_STATES = ['COMPLETED','FAILED','TIMEOUT','CANCELLED',
+                   'OUT_OF_MEMORY','NODE_FAIL','BOOT_FAIL','DEADLINE']
+
+def get_job_states(jobids,chunk_size=500):
+    '''Queries the states of SLURM jobs with as few sacct calls as possible
+
+    Returns a dict mapping job IDs (e.g. 1234 or array tasks like
+    1234_5) to their state (e.g. COMPLETED). Jobs unknown to sacct
+    are left out.
+    '''
+    jobids = list(dict.fromkeys([str(j) for j in jobids]))
+    states = {}
+    for i in range(0,len(jobids),chunk_size):
+        output = run_local(['sacct', '-X', '-P', '--noheader',
+                            '-j', ','.join(jobids[i:i+chunk_size]),
+                            '--format=JobID,State'],
+                           verbose=False).split('\n')
+        for line in output:
+            if line.strip()=='': continue
+            try:
+                jobid,state = line.strip().split('|')
+            except ValueError:
+                raise_exception(f"Unexpected output from sacct: {line}")
+            # e.g. "CANCELLED by 1234"
+            states[jobid] = state.split()[0] if state.strip()!='' else ''
+    return states
+
+class SlurmBackend(object):
+    '''Submits batch scripts with sbatch and queries the states of jobs with sacct
+
+    Other scheduler backends (like the local emulator in emulator.py)
+    provide the same methods:
+    submit() submits a batch script and returns its job ID
+    get_job_states() returns the states of jobs, like get_job_states()
+    get_max_array_size() returns the most tasks a job array can have
+    wait() returns once the jobs submitted no longer need this process
+    '''
+    name = 'slurm'
+
+    def submit(self,fname,depstr=None,array=None,dry_run=False):
+        cmds = []
+        cmds.append('sbatch')
+        cmds.append(f'--parsable')
+        if depstr is not None: cmds.append(f'{depstr}')
+        if array is not None: cmds.append(f'--array={array}')
+        cmds.append(fname)
+        return run_local(cmds,dry_run).strip()
+
+    def get_job_states(self,jobids):
+        return get_job_states(jobids)
+
+    def get_max_array_size(self):
+        '''The MaxArraySize of the cluster, from scontrol show config'''
+        import shutil
+        if shutil.which('scontrol') is None: return DEFAULT_MAX_ARRAY_SIZE
+        try:
+            output = subprocess.run(['scontrol','show','config'],stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+        except OSError:
+            return DEFAULT_MAX_ARRAY_SIZE
+        m = re.search(r'^MaxArraySize\s*=\s*(\d+)',output,re.MULTILINE)
+        return int(m.group(1)) if m is not None else DEFAULT_MAX_ARRAY_SIZE
+
+    def wait(self):
+        pass
+
+def load_index(root_dir,project):
+    '''Loads the index of a project, or returns None if it has none
+
+    The index records the last submission of each stage, e.g.
+    {'stages': {'stage1': {'jobid': '1234', 'site': 'niagara',
+                           'status': 'COMPLETED', 'time': ...,
+                           'fingerprint': ..., 'git_fingerprint': ...}}}
+    where status is None until the job is seen in one of the
+    TERMINAL_STATES, after which it never changes. The record of a sweep
+    also has the sweep it ran, the points of it that did not complete as
+    failed (see update_sweep_record()), and the job arrays that ran them as
+    chunks. Stages handed to an
+    allocation job keep their last record until the job runs them, and
+    the job is noted under 'pending', e.g.
+    {'pending': {'stage1': {'jobid': '1240', 'site': 'niagara'}}}
+    '''
+    fname = get_index_filename(root_dir,project)
+    if not(os.path.exists(fname)): return None
+    with open(fname,'r') as f:
+        return json.load(f)
+
+def save_index(root_dir,project,index):
+    fname = get_index_filename(root_dir,project)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    # Write to a temporary file first so that an interrupted run does
+    # not leave behind a corrupted index
+    with open(fname+'.tmp','w') as f:
+        json.dump(index,f,default=str)
+    os.replace(fname+'.tmp',fname)
+
+def get_index_record(jobid,site,status,fingerprint,git_fingerprint):
+    record = {}
+    record['jobid'] = str(jobid)
+    record['site'] = site
+    record['status'] = status
+    record['time'] = int(time.time()*1e3) # Save time when it was saved
+    record['fingerprint'] = fingerprint
+    record['git_fingerprint'] = git_fingerprint
+    return record
+
+# Files that mbatch itself writes into stage output directories
+MBATCH_FILE_PREFIXES = ('slurm_out_','slurm_state_','local_out_','local_log_','stage_config_','slurm_submission_','mbatch_hashes',
+                        'array_tasks_','farm_tasks_','farm_failed_','sweep_values_')
+
+# Cache of the hashes of the files in a stage output directory
+HASH_CACHE_FILE = 'mbatch_hashes.json'
+
+def get_output_hash(output_dir,chunk_size=1<<20):
+    '''Content hash of the products of a stage in its output directory
+
+    Files are hashed one by one in a deterministic order, leaving out the
+    files written by mbatch itself, so that a re-run of a stage that
+    writes byte-identical products gives the same hash. The hash of each
+    file is cached in mbatch_hashes.json in the output directory along
+    with its size, inode and modification and change times, so files
+    that have not changed since they were last hashed are not read again.
+    '''
+    cache_file = os.path.join(output_dir,HASH_CACHE_FILE)
+    try:
+        with open(cache_file,'r') as f:
+            cache = json.load(f)
+    except (OSError,ValueError):
+        cache = {}
+    new_cache = {}
+    h = hashlib.sha256()
+    for dirpath,dirnames,filenames in os.walk(output_dir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if fname.startswith(MBATCH_FILE_PREFIXES): continue
+            path = os.path.join(dirpath,fname)
+            rel = os.path.relpath(path,output_dir)
+            st = os.stat(path)
+            key = [st.st_size,st.st_mtime_ns,st.st_ctime_ns,st.st_ino]
+            cached = cache.get(rel,None)
+            if (cached is not None) and (cached[:4]==key):
+                fhash = cached[4]
+            else:
+                fh = hashlib.sha256()
+                with open(path,'rb') as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b''):
+                        fh.update(chunk)
+                fhash = fh.hexdigest()
+            new_cache[rel] = key + [fhash]
+            h.update(f'{rel}\0{st.st_size}\0{fhash}\0'.encode('utf-8'))
+    if new_cache!=cache:
+        try:
+            with open(cache_file+'.tmp','w') as f:
+                json.dump(new_cache,f)
+            os.replace(cache_file+'.tmp',cache_file)
+        except OSError:
+            pass # e.g. a read-only directory; we just read the files again next time
+    return h.hexdigest()
+
+def get_output_hashes(output_dirs,max_workers=8):
+    # Hashing is mostly waiting on the filesystem, so we hash several directories at once
+    if len(output_dirs)==0: return []
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,min(max_workers,len(output_dirs)))) as pool:
+        return list(pool.map(get_output_hash,output_dirs))
+
+def get_sweep_output_hash(root_dir,stage,project,sweep):
+    # What a sweep wrote is what all of its points wrote
+    return get_fingerprint(get_output_hashes([get_output_dir(root_dir,f'{stage}_{label}',project) for label in sweep.iter_labels()]))
+
+def get_input_hash(stage_deps,records):
+    # Combined output hash of the stages a stage depends on, or None
+    # if any of them is unknown
+    hashes = []
+    for d in stage_deps:
+        output_hash = records[d].get('output_hash',None) if d in records else None
+        if output_hash is None: return None
+        hashes.append([d,output_hash])
+    return get_fingerprint(hashes)
+
+def get_fingerprint(obj):
+    # Canonical SHA-256 hash of a JSON-serializable object
+    return hashlib.sha256(json.dumps(obj,sort_keys=True,default=str,
+                                     separators=(',',':')).encode('utf-8')).hexdigest()
+
+def find_module_files(base,parts):
+    '''Returns the files that importing the module base/parts[0]/parts[1]/... would run'''
+    files = []
+    path = base
+    for part in parts:
+        path = os.path.join(path,part)
+        init = os.path.join(path,'__init__.py')
+        if os.path.isfile(init):
+            files.append(init)
+        elif os.path.isfile(path+'.py'):
+            files.append(path+'.py')
+            break # The rest are names inside this module
+        elif not(os.path.isdir(path)): # namespace packages have no __init__.py
+            break
+    return files
+
+def find_local_imports(fname,content,root,external=None):
+    '''Returns the files under root imported by the python source in fname
+
+    If external is a set, the top-level names of the modules imported from
+    outside root (e.g. numpy for import numpy.fft) are added to it.
+    '''
+    import ast
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError,ValueError):
+        return [] # Not a python script
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Import):
+            modules += [(root,alias.name.split('.')) for alias in node.names]
+        elif isinstance(node,ast.ImportFrom):
+            base = root
+            if node.level>0: # relative import
+                base = os.path.dirname(fname)
+                for i in range(node.level-1): base = os.path.dirname(base)
+            parts = node.module.split('.') if node.module else []
+            modules.append((base,parts))
+            # The imported names can be submodules too
+            modules += [(base,parts+[alias.name]) for alias in node.names if alias.name!='*']
+    files = []
+    for base,parts in modules:
+        files += find_module_files(base,parts)
+        if (external is not None) and (base==root) and len(parts)>0 and \
+           not(os.path.isdir(os.path.join(root,parts[0])) or os.path.isfile(os.path.join(root,parts[0]+'.py'))):
+            external.add(parts[0])
+    return files
+
+def get_script_hash(script,external=None):
+    '''Content hash of a script and the local modules it imports
+
+    The imports are found statically by walking the syntax tree of the
+    script and then of every imported module that lives in the script's
+    directory. Installed packages are covered by the git checks instead.
+    Returns None if the script is not a file, e.g. if it is on the PATH.
+    external is passed on to find_local_imports().
+    '''
+    script = os.path.abspath(script)
+    if not(os.path.isfile(script)): return None
+    root = os.path.dirname(script)
+    hashes = {}
+    todo = [script]
+    while len(todo)>0:
+        fname = todo.pop()
+        if fname in hashes: continue
+        with open(fname,'rb') as f:
+            content = f.read()
+        hashes[fname] = hashlib.sha256(content).hexdigest()
+        todo += find_local_imports(fname,content,root,external)
+    return get_fingerprint(sorted([[os.path.relpath(f,root),h] for f,h in hashes.items()]))
+
+@functools.lru_cache(maxsize=None)
+def get_external_imports(script):
+    # Top-level names of the modules a script imports from outside its directory
+    external = set()
+    get_script_hash(script,external)
+    return frozenset(external)
+
+def get_repo_root(path):
+    # The top directory of the git repository that path is in, or path if none
+    path = os.path.abspath(path)
+    parent = path
+    while True:
+        if os.path.exists(os.path.join(parent,'.git')): return parent
+        if os.path.dirname(parent)==parent: return path
+        parent = os.path.dirname(parent)
+
+def could_import_from(path,names):
+    '''Whether any of the top-level modules could be imported from files under path
+
+    They could if path has a package or module of that name at its top
+    (e.g. for a PYTHONPATH set in the batch script) or if python finds
+    it there now, e.g. through PYTHONPATH or an editable install. Only
+    top-level names are looked up, which imports nothing.
+    '''
+    import importlib.util
+    path = os.path.join(os.path.realpath(path),'')
+    stdlib = set(sys.builtin_module_names) | set(getattr(sys,'stdlib_module_names',[]))
+    for name in names:
+        if name in stdlib: continue
+        if os.path.isdir(os.path.join(path,name)) or os.path.isfile(os.path.join(path,name+'.py')): return True
+        try:
+            spec = importlib.util.find_spec(name)
+        except (ImportError,ValueError):
+            spec = None
+        if spec is None: continue
+        # origin is 'frozen' or 'built-in' rather than a path for modules without a file
+        locations = list(spec.submodule_search_locations or []) + ([spec.origin] if spec.has_location and spec.origin else [])
+        if any([os.path.join(os.path.realpath(l),'').startswith(path) for l in locations]): return True
+    return False
+
+def get_stage_fingerprints(ostages,global_vals):
+    '''Content hashes of the configuration of unrolled stages
+
+    The hash covers everything in the stage configuration apart from
+    the parallel section, farm, sweep and the git checks (see get_git_fingerprints()),
+    with the values of the globals the stage uses and the absolute
+    path and contents (see get_script_hash()) of its script, followed
+    by its positional argument. Iterations of a looped stage share the hash
+    of their parent's configuration, so it is only computed once. The
+    points of a sweep are left out, since a sweep keeps track of which
+    of its points completed in its index record (see get_sweep_todo()).
+    '''
+    base_fingerprints = {}
+    script_hashes = {} # Stages often share scripts
+    fingerprints = {}
+    for stage,ostage in ostages.items():
+        key = id(ostage.config)
+        if not(key in base_fingerprints):
+            config = {k:v for k,v in ostage.config.items() if not(k in ['arg','parallel','farm','sweep','gitcheck_pkgs','gitcheck_paths'])}
+            if 'script' in config:
+                config['script'] = os.path.abspath(config['script'])
+                if not(config['script'] in script_hashes):
+                    script_hashes[config['script']] = get_script_hash(config['script'])
+                config['script_hash'] = script_hashes[config['script']]
+            config['globals'] = {g: global_vals.get(g,None) for g in ostage.config.get('globals',[])}
+            base_fingerprints[key] = get_fingerprint(config)
+        fingerprints[stage] = get_fingerprint([base_fingerprints[key],ostage.get('arg',None)])
+    return fingerprints
+
+def get_stage_gitdicts(ostage,pkg_gitdict,pth_gitdict):
+    '''Returns the parts of pkg_gitdict and pth_gitdict that a stage depends on
+
+    A stage can list the gitcheck_pkgs and gitcheck_paths it depends on
+    (out of those listed at the top of the config), so that commits to
+    other repositories do not stop it from being reused. Stages that
+    do not list them depend on all of them.
+    '''
+    gitdicts = []
+    for cname,gitdict in [('gitcheck_pkgs',pkg_gitdict),('gitcheck_paths',pth_gitdict)]:
+        names = ostage.get(cname,None)
+        if names is None:
+            gitdicts.append(gitdict)
+            continue
+        for name in names:
+            if not(name in gitdict): raise_exception(f"{name} is in the {cname} of a stage but not in the global {cname}.")
+        gitdicts.append({name: gitdict[name] for name in names})
+    return gitdicts
+
+def get_git_fingerprint(ostage,pkgs,pths):
+    '''Hash of the git information of the packages and paths a stage depends on
+
+    A path that contains the script of the stage is left out if the
+    script can't import anything else from its repository, since the
+    stage fingerprint already has the contents of the script and the
+    modules it imports from its directory (see get_script_hash()).
+    Otherwise a commit or an uncommitted change to any other file in the
+    repository of the pipeline scripts would stop every stage from being
+    reused. If the script imports modules that could come from elsewhere
+    in the repository (e.g. repo/scripts/s.py importing repo/mylib.py),
+    the path is kept, since commits to those are not in the script hash.
+    '''
+    script = ostage.get('script',None)
+    if (script is not None) and os.path.isfile(script):
+        script = os.path.abspath(script)
+        kept = {}
+        for name,info in pths.items():
+            if script.startswith(os.path.join(os.path.abspath(info['path']),'')) and \
+               not(could_import_from(get_repo_root(info['path']),get_external_imports(script))):
+                continue
+            kept[name] = info
+        pths = kept
+    return get_fingerprint([pkgs,pths])
+
+def get_git_fingerprints(ostages,pkg_gitdict,pth_gitdict):
+    # Hashes of the git information each of the unrolled stages depends on (see get_git_fingerprint())
+    base_fingerprints = {}
+    fingerprints = {}
+    for stage,ostage in ostages.items():
+        key = id(ostage.config)
+        if not(key in base_fingerprints):
+            base_fingerprints[key] = get_git_fingerprint(ostage,*get_stage_gitdicts(ostage,pkg_gitdict,pth_gitdict))
+        fingerprints[stage] = base_fingerprints[key]
+    return fingerprints
+
+def scan_project_history(root_dir,project,stages,site,global_vals,backend=None):
+    '''Builds index records from the files in the stage output directories
+
+    This is only needed for projects last run with a version of mbatch
+    that did not keep an index. For each stage, the last SLURM job and
+    the last local run are found, and the most recent completed one
+    is recorded. A stage that shared its job with others completed if it
+    wrote its get_slurm_state_file() marker, even if the job failed later.
+    '''
+    # Stages never run in this project have no output directory to look in,
+    # and the others are listed once rather than globbed for each kind of file
+    pdir = get_project_dir(root_dir,project)
+    existing = set(os.listdir(pdir)) if os.path.isdir(pdir) else set()
+    stages = [stage for stage in stages if (stage in existing) and os.path.isdir(get_output_dir(root_dir,stage,project))]
+    listings = {stage: os.listdir(get_output_dir(root_dir,stage,project)) for stage in stages}
+    def _ids(stage,root):
+        root = os.path.basename(root) + "_"
+        suffix = ".txt"
+        return [f[len(root):-len(suffix)] for f in listings[stage] if f.startswith(root) and f.endswith(suffix)]
+
+    last_jobs = {}
+    for stage in stages:
+        ids = _ids(stage,get_out_file_root(root_dir,stage,project,site))
+        if len(ids)!=0:
+            last_jobs[stage] = max(ids,key=jobid_key)
+    if backend is None: backend = SlurmBackend()
+    job_states = backend.get_job_states(list(last_jobs.values())) if len(last_jobs)>0 else {}
+
+    records = {}
+    for stage in stages:
+        candidates = []
+        if (job_states.get(last_jobs.get(stage,None),None)=='COMPLETED') or \
+           ((stage in last_jobs) and os.path.exists(get_slurm_state_file(root_dir,stage,project)+f"_{last_jobs[stage]}.txt")):
+            candidates.append((last_jobs[stage],site))
+        ids = _ids(stage,get_local_out_file(root_dir,stage,project))
+        if len(ids)!=0:
+            last_job_local = max([sint(i) for i in ids])
+            with open(get_local_out_file(root_dir,stage,project)+f"_{last_job_local}.txt",'r') as f:
+                if f.read().strip()=='COMPLETED': candidates.append((str(last_job_local),'local'))
+        for jobid,jsite in candidates:
+            import yaml
+            try:
+                with open(get_stage_config_filename(root_dir,stage,project,jobid), 'r') as stream:
+                    saved_config = yaml.safe_load(stream)['stage']
+            except:
+                fprint(HTML(f"<ansiyellow>Could not find saved configuration for {stage} even though completed job was detected. Will not re-use this stage.</ansiyellow>"))
+                continue
+            if (stage in records) and (records[stage]['time']>=saved_config['time']): continue
+            fingerprint = get_stage_fingerprints({stage: Stage(saved_config[stage])},global_vals)[stage]
+            git_fingerprint = get_git_fingerprint(Stage(saved_config[stage]),saved_config['pkg_gitdict'],saved_config['pth_gitdict'])
+            records[stage] = get_index_record(jobid,jsite,'COMPLETED',fingerprint,git_fingerprint)
+            records[stage]['time'] = saved_config['time']
+    return records
+
 def detect_site():
     sites = []
     env_check = os.environ.get('CLUSTER',None)
@@ -154,7 +894,7 @@ def detect_site():
 
 def get_site_path():
     # First try ~/.mbatch/*.yml
-    home = str(Path.home())
+    home = os.path.expanduser('~')
     homepath = os.path.join(home,".mbatch")
     fs = glob.glob(homepath+"/*.yml")
     if len(fs)>=1: return homepath
@@ -164,6 +904,7 @@ def get_site_path():
     return template_path
 
 def load_template(site):
+    import yaml
     template_path = os.path.join(get_site_path(), f"{site}.yml")
     with open(template_path, 'r') as stream:
         sbatch_config = yaml.safe_load(stream)
@@ -172,9 +913,27 @@ def load_template(site):
 def get_out_file_root(root_dir,stage,project,site):
     return os.path.join(get_output_dir(root_dir,stage,project),f'slurm_out_{stage}_{project}_{site}')
 
+def get_slurm_state_file(root_dir,stage,project):
+    # Root of the marker a stage writes when it completes inside a job it shares with others
+    return os.path.join(get_output_dir(root_dir,stage,project),f'slurm_state_{stage}_{project}')
+
 def get_local_out_file(root_dir,stage,project):
     return os.path.join(get_output_dir(root_dir,stage,project),f'local_out_{stage}_{project}_state')
 
+def get_local_log_file(root_dir,stage,project,jobid):
+    return os.path.join(get_output_dir(root_dir,stage,project),f'local_log_{stage}_{project}_{jobid}.txt')
+
+_local_jobid_lock = threading.Lock()
+_last_local_jobid = 0
+
+def get_local_jobid():
+    # Unix milliseconds as a job ID for a local run, bumped past the last one
+    # we handed out so stages starting in the same millisecond don't share it
+    global _last_local_jobid
+    with _local_jobid_lock:
+        _last_local_jobid = max(int(time.time()*1e3),_last_local_jobid+1)
+        return str(_last_local_jobid)
+
 
 def get_project_dir(root_dir,project):
     return os.path.join(root_dir,project)
@@ -182,10 +941,27 @@ def get_project_dir(root_dir,project):
 def get_output_dir(root_dir,stage,project):
     return os.path.abspath(os.path.join(get_project_dir(root_dir,project),stage))
 
+def get_index_filename(root_dir,project):
+    return os.path.join(get_project_dir(root_dir,project),'mbatch_index.json')
+
 def get_stage_config_filename(root_dir,stage,project,jobid):
     return os.path.join(get_output_dir(root_dir,stage,project),f'stage_config_{jobid}.yml')
 
 
+def save_stage_config(root_dir,stage,project,record,ostage,pkg_gitdict,pth_gitdict):
+    out_dict = {}
+    out_dict['stage'] = {stage: ostage.to_dict()}
+    # Only the git information that the stage depends on
+    pkg_gitdict,pth_gitdict = get_stage_gitdicts(ostage,pkg_gitdict,pth_gitdict)
+    out_dict['stage']['pkg_gitdict'] = pkg_gitdict
+    out_dict['stage']['pth_gitdict'] = pth_gitdict
+    out_dict['stage']['time'] = record['time']
+    out_dict['stage']['fingerprint'] = record['fingerprint']
+    out_dict['stage']['git_fingerprint'] = record['git_fingerprint']
+    import yaml
+    with open(get_stage_config_filename(root_dir,stage,project,record['jobid']), 'w') as f:
+        yaml.dump(out_dict, f, default_flow_style=False)
+
 def get_default(config,name,arg):
     if not(arg is None):
         return arg
@@ -200,31 +976,23 @@ def get_tpc(sbatch_config,constraint,partition):
         tpc = 2
     return tpc
     
-def submit_slurm(stage,sbatch_config,parallel_config,execution,
-                 script,pargs,dry_run,output_dir,site,project,root_dir,
-                 depstr=None,account=None,qos=None,partition=None,constraint=None,extra=''):
-
-    constraint = get_default(sbatch_config,'constraint',constraint)
-    qos = get_default(sbatch_config,'qos',qos)
-    partition = get_default(sbatch_config,'part',partition)
-    account = get_default(sbatch_config,'account',account)
-    cpn = sbatch_config['architecture'][constraint][partition]['cores_per_node']
-    tpc = get_tpc(sbatch_config,constraint,partition)
-    template = sbatch_config['template']
-    cmd = ' '.join([execution,script,pargs]) + f' --output-dir {output_dir}'
-    try:
-        nproc = parallel_config['nproc']
-    except (TypeError,KeyError) as e:
-        nproc = 1
-        fprint(HTML(f"<ansiyellow>No stage['parallel']['nproc'] found for {stage}. Assuming number of MPI processes nproc=1.</ansiyellow>"))
-
+def get_threads(stage,parallel_config,arch,default=None):
+    '''Number of OpenMP threads for each process of a stage
+
+    This is either the threads in the parallel section of the stage, or
+    enough threads (at least min_threads) for each process to get memory_gb
+    of the memory of a node described by arch (an entry of the
+    architecture of a site configuration). If neither is specified, this
+    is default, or all the cores of a node if default is None.
+    '''
+    cpn = arch['cores_per_node']
     try:
         memory_gb = parallel_config['memory_gb']
         if 'threads' in list(parallel_config.keys()): raise_exception("Both memory_gb and threads should not be specified.")
-        if not('memory_per_node_gb' in list(sbatch_config['architecture'][constraint][partition].keys())): raise_exception("Using memory_gb but no memory_per_node_gb in site configuration.")
+        if not('memory_per_node_gb' in list(arch.keys())): raise_exception("Using memory_gb but no memory_per_node_gb in site configuration.")
         if not('min_threads' in list(parallel_config.keys())): raise_exception("Need min_threads if using memory_gb.")
         # Maximum number of processes per node
-        threads = max(math.ceil(1.*cpn/sbatch_config['architecture'][constraint][partition]['memory_per_node_gb']*parallel_config['memory_gb'] ),parallel_config['min_threads'])
+        threads = max(math.ceil(1.*cpn/arch['memory_per_node_gb']*parallel_config['memory_gb'] ),parallel_config['min_threads'])
         threads = threads + (threads%2)
         fprint(HTML(f"<ansiyellow>Converted memory {memory_gb} GB to number of threads {threads}.</ansiyellow>"))
     except (TypeError,KeyError) as e:
@@ -234,27 +1002,442 @@ def submit_slurm(stage,sbatch_config,parallel_config,execution,
         try:
             threads = parallel_config['threads']
         except (TypeError,KeyError) as e:
+            if default is not None: return default
             threads = cpn
             fprint(HTML(f"<ansiyellow>No stage['parallel']['threads'] found for {stage}. Assuming number of OpenMP threads={cpn}.</ansiyellow>"))
-        
+    return threads
+
+# Set to the number of threads for local runs, for OpenMP and the usual BLAS libraries
+THREAD_ENV_VARS = ['OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS','NUMEXPR_NUM_THREADS']
+
+def get_mpi_launcher(nproc,mpirun=None):
+    '''Command to prepend to run nproc MPI processes locally
+
+    This is empty for a single process, and None if we need MPI but
+    mpirun (or mpiexec) can't be found.
+    '''
+    if nproc<=1: return []
+    if mpirun is None:
+        import shutil
+        mpirun = shutil.which('mpirun') or shutil.which('mpiexec')
+        if mpirun is None: return None
+    return [mpirun,'-n',str(nproc)]
+
+def get_machine_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**3
+    except (ValueError,OSError,AttributeError):
+        return None
+
+def run_dag(stages,deps,resources,run,finish,ncores,memory_gb):
+    '''Runs stages as soon as the stages they depend on have completed
+
+    stages should be in dependency order, and deps should map each of
+    them to the ones among them that it depends on. A stage is started
+    (in its own thread, with run(stage)) when its resources, a tuple of
+    (cores, memory in GB), fit in what is left of ncores and memory_gb.
+    Stages that need more than that are run once nothing else is running.
+    run should return 'COMPLETED', 'FAILED' or 'REUSED' (which counts
+    as completed). finish(stage,state) is then called from this thread.
+    Stages that depend on a stage that failed are not run, and get the
+    state 'CANCELLED'.
+    '''
+    import queue
+    done = queue.Queue()
+    def _run(stage):
+        try:
+            state = run(stage)
+        except Exception as e:
+            state = 'FAILED'
+        done.put((stage,state))
+    states = {}
+    pending = list(stages)
+    running = set()
+    used_cores = 0
+    used_memory = 0.
+    while len(pending)>0 or len(running)>0:
+        waiting = []
+        for stage in pending:
+            dstates = [states.get(d,None) for d in deps.get(stage,[])]
+            if any([s in ['FAILED','CANCELLED'] for s in dstates]):
+                states[stage] = 'CANCELLED'
+                finish(stage,'CANCELLED')
+                continue
+            cores,memory = resources[stage]
+            fits = (used_cores+cores<=ncores) and ((memory_gb is None) or (used_memory+memory<=memory_gb))
+            if not(all([s in ['COMPLETED','REUSED'] for s in dstates])) or not(fits or len(running)==0):
+                waiting.append(stage)
+                continue
+            running.add(stage)
+            used_cores += cores
+            used_memory += memory
+            threading.Thread(target=_run,args=(stage,),daemon=True).start()
+        pending = waiting
+        if len(running)==0: break
+        stage,state = done.get()
+        running.remove(stage)
+        used_cores -= resources[stage][0]
+        used_memory -= resources[stage][1]
+        states[stage] = state
+        finish(stage,state)
+    return states
+
+def parse_walltime(walltime):
+    '''Returns a SLURM time limit like 1-02:03:04, 02:03:04, 03:04 or 4 in seconds, or None for no limit'''
+    days = 0
+    if '-' in walltime:
+        days,walltime = walltime.split('-')
+    parts = [int(float(x)) for x in walltime.split(':')]
+    if len(parts)==1: parts = [0,parts[0],0] # minutes
+    elif len(parts)==2: parts = [0] + parts
+    seconds = ((int(days)*24 + parts[0])*60 + parts[1])*60 + parts[2]
+    return None if seconds==0 else seconds
+
+def format_walltime(seconds):
+    '''The inverse of parse_walltime'''
+    if seconds is None: return "0"
+    days,seconds = divmod(int(seconds),86400)
+    hms = f'{seconds//3600:02d}:{(seconds%3600)//60:02d}:{seconds%60:02d}'
+    return f'{days}-{hms}' if days>0 else hms
+
+def get_stage_parallel(stage,sbatch_config,parallel_config,constraint,partition):
+    '''Number of MPI processes, threads and walltime of a stage, with defaults for what is not specified'''
+    try:
+        nproc = parallel_config['nproc']
+    except (TypeError,KeyError) as e:
+        nproc = 1
+        fprint(HTML(f"<ansiyellow>No stage['parallel']['nproc'] found for {stage}. Assuming number of MPI processes nproc=1.</ansiyellow>"))
+
+    threads = get_threads(stage,parallel_config,sbatch_config['architecture'][constraint][partition])
+
     try:
         walltime = parallel_config['walltime']
     except (TypeError,KeyError) as e:
         walltime = "0"
         fprint(HTML(f"<ansiyellow>No stage['parallel']['walltime'] found for <b>{stage}</b>. Assuming <b>walltime of {walltime}</b>.</ansiyellow>"))
+    return nproc,threads,walltime
+
+def get_num_nodes(nproc,threads,cpn):
+    return int(math.ceil(nproc*threads/cpn))
+
+def get_step_cores(nproc,threads,cpn):
+    # Cores a job step takes up; steps over more than one node take whole nodes
+    num_nodes = get_num_nodes(nproc,threads,cpn)
+    return nproc*threads if num_nodes<=1 else num_nodes*cpn
+
+def get_fusable_chains(stages,deps,can_fuse):
+    '''Chains of stages that can run one after another in a single job
+
+    stages should be in dependency order. A stage joins the chain of the
+    stage before it if it depends on that stage alone, nothing else
+    depends on that stage, and can_fuse(stage before, stage) is True.
+    Returns a dict mapping the first stage of each chain of two or more
+    stages to the list of stages in that chain.
+    '''
+    ndependents = {}
+    for stage in stages:
+        for d in deps.get(stage,[]): ndependents[d] = ndependents.get(d,0) + 1
+    chain_of = {}
+    for stage in stages:
+        sdeps = deps.get(stage,[])
+        if (len(sdeps)==1) and (ndependents[sdeps[0]]==1) and can_fuse(sdeps[0],stage):
+            chain_of[stage] = chain_of[sdeps[0]]
+            chain_of[stage].append(stage)
+        else:
+            chain_of[stage] = [stage]
+    return {chain[0]: chain for stage,chain in chain_of.items() if (stage==chain[0]) and (len(chain)>1)}
+
+def get_fused_template(template,cmds,out_files,markers):
+    '''A batch script template that runs several commands one after another
+
+    The line of template with !CMD is repeated for each of cmds, with its
+    output going to the matching out_files. Once a command succeeds, the
+    matching file in markers is written; the first one that fails ends the
+    job with its exit code.
+    '''
+    lines = []
+    for line in template.split('\n'):
+        if not('!CMD' in line):
+            lines.append(line)
+            continue
+        for i,(cmd,out_file,marker) in enumerate(zip(cmds,out_files,markers)):
+            lines.append(f'# mbatch fused stage {i+1} of {len(cmds)}')
+            lines.append(line.replace('!CMD',f'{cmd} > "{out_file}" 2>&1') + ' || exit $?')
+            lines.append(f'echo COMPLETED > "{marker}"')
+    return '\n'.join(lines)
+
+def get_allocation_size(stages,deps,cores,walltimes,cpn,max_nodes=None):
+    '''Nodes and walltime (in seconds) of one allocation to run stages in
+
+    stages should be in dependency order, and deps should map each of
+    them to the ones among them that it depends on. Stages are grouped
+    in levels: the first has those that don't depend on others, the next
+    those that depend on the first, etc. The allocation has enough nodes
+    for the cores of the widest level, but no more than max_nodes (or
+    than the biggest stage needs, if that is more). When a level doesn't
+    fit, its stages run in turns as cores free up, as they would in
+    run_dag(), and the allocation gets enough time for the levels one
+    after another. A walltime of None (no limit) for any stage means no
+    limit for the allocation too.
+    '''
+    import heapq
+    levels = {}
+    for stage in stages:
+        levels[stage] = 1 + max([levels[d] for d in deps.get(stage,[])],default=-1)
+    nlevels = max(levels.values())+1
+    width = [0]*nlevels
+    for stage in stages:
+        width[levels[stage]] += cores[stage]
+    num_nodes = get_num_nodes(max(width),1,cpn)
+    if max_nodes is not None:
+        num_nodes = max(min(num_nodes,max_nodes),max([get_num_nodes(c,1,cpn) for c in cores.values()]))
+    if any([walltimes[stage] is None for stage in stages]): return num_nodes,None
+    seconds = 0
+    for level in range(nlevels):
+        # Start each stage of the level once there are enough free cores
+        free = num_nodes*cpn
+        now = end = 0
+        running = []
+        for stage in stages:
+            if levels[stage]!=level: continue
+            while free<cores[stage]:
+                now,c = heapq.heappop(running)
+                free += c
+            heapq.heappush(running,(now+walltimes[stage],cores[stage]))
+            free -= cores[stage]
+            end = max(end,now+walltimes[stage])
+        seconds += end
+    return num_nodes,seconds
+
+def submit_slurm(stage,sbatch_config,parallel_config,execution,
+                 script,pargs,dry_run,output_dir,site,project,root_dir,
+                 depstr=None,account=None,qos=None,partition=None,constraint=None,extra='',
+                 array=None,preamble='',backend=None):
+
+    constraint = get_default(sbatch_config,'constraint',constraint)
+    qos = get_default(sbatch_config,'qos',qos)
+    partition = get_default(sbatch_config,'part',partition)
+    account = get_default(sbatch_config,'account',account)
+    cpn = sbatch_config['architecture'][constraint][partition]['cores_per_node']
+    tpc = get_tpc(sbatch_config,constraint,partition)
+    template = sbatch_config['template']
+    # Job array tasks pick their output directory in the preamble
+    cmd_output_dir = output_dir if array is None else '"$MBATCH_OUTPUT_DIR"'
+    cmd = ' '.join([execution,script,pargs]) + f' --output-dir {cmd_output_dir}'
+    nproc,threads,walltime = get_stage_parallel(stage,sbatch_config,parallel_config,constraint,partition)
 
     name = f'{stage}_{project}'
     out_file_root = get_out_file_root(root_dir,stage,project,site)
     sbatch_file_root = get_sbatch_script_file_root(output_dir,project,stage,site)
     return submit_slurm_core(template,name,cmd,nproc,cpn,threads,walltime,dry_run,
                              output_dir,site,out_file_root,sbatch_file_root,
-                             depstr=depstr,account=account,qos=qos,partition=partition,constraint=constraint,threads_per_core=tpc)
+                             depstr=depstr,account=account,qos=qos,partition=partition,constraint=constraint,threads_per_core=tpc,
+                             array=array,preamble=preamble,backend=backend)
+
+def insert_preamble(template,preamble):
+    # Insert shell commands right after the #SBATCH directives of a batch script
+    lines = template.split('\n')
+    pos = 1
+    for i,line in enumerate(lines):
+        if line.startswith('#SBATCH'): pos = i+1
+    return '\n'.join(lines[:pos] + [preamble] + lines[pos:])
+
+def format_array(task_ids):
+    '''The --array spec of sorted task IDs, with runs written as ranges, e.g. 0-5,7,9-12'''
+    parts = []
+    start = prev = None
+    for i in task_ids:
+        if (prev is not None) and (i==prev+1):
+            prev = i
+            continue
+        if start is not None: parts.append(f'{start}-{prev}' if prev>start else f'{start}')
+        start = prev = i
+    if start is not None: parts.append(f'{start}-{prev}' if prev>start else f'{start}')
+    return ','.join(parts)
+
+def get_array_chunks(indices,max_array_size):
+    '''Splits sorted task indices into job arrays that SLURM accepts
+
+    SLURM rejects task IDs of max_array_size (MaxArraySize) or more, so
+    index i goes to the array of the indices from k*max_array_size to
+    (k+1)*max_array_size-1, with task ID i-k*max_array_size. Returns a
+    list of (offset,task IDs) with one entry for each array.
+    '''
+    chunks = []
+    for i in indices:
+        offset = (i//max_array_size)*max_array_size
+        if (len(chunks)==0) or (chunks[-1][0]!=offset): chunks.append((offset,[]))
+        chunks[-1][1].append(i-offset)
+    return chunks
+
+def write_array_tasks(fname,args,output_dirs,out_file_roots):
+    '''Writes the table of the iterations of a job array, one line each
+
+    Each line has the shell-quoted argument, output directory and SLURM
+    output file root of an iteration, to be read by get_array_preamble().
+    '''
+    with open(fname,'w') as f:
+        for fields in zip(args,output_dirs,out_file_roots):
+            line = ' '.join([shlex.quote(x) for x in fields])
+            if '\n' in line: raise_exception(f"Arguments of job array tasks can't have line breaks: {fields[0]!r}")
+            f.write(line+'\n')
+
+def get_array_preamble(tasks_file,offset=0):
+    '''Shell commands that make a job array task pick its loop iteration
+
+    The task reads line SLURM_ARRAY_TASK_ID+offset (counting from 0) of
+    the tasks_file written by write_array_tasks(), exports the argument
+    and output directory of the iteration as MBATCH_ARG and
+    MBATCH_OUTPUT_DIR, and redirects its output to the SLURM output file
+    of the iteration, i.e. {out_file_root}_{arrayjobid}_{taskid}.txt
+    The table is kept out of the batch script, which SLURM limits in size.
+    '''
+    return '\n'.join([
+        '',
+        '# mbatch job array: each task runs the iteration on its line of the tasks file',
+        f'MBATCH_TASK="$(sed -n "$((SLURM_ARRAY_TASK_ID+{offset}+1)){{p;q}}" {shlex.quote(tasks_file)})"',
+        'eval "set -- $MBATCH_TASK"',
+        'export MBATCH_ARG="$1" MBATCH_OUTPUT_DIR="$2"',
+        'exec > "${3}_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.txt" 2>&1',
+        'set --',
+        ''])
+
+def iter_array(spec):
+    '''The task IDs of an --array spec written by format_array(), in order'''
+    for part in spec.split(','):
+        if part=='': continue
+        if '-' in part:
+            start,end = part.split('-')
+            yield from range(int(start),int(end)+1)
+        else:
+            yield int(part)
+
+def get_sweep_todo(sweep,record,stage):
+    '''Indices of the points of a sweep that are not recorded as completed
+
+    The index record of a sweep has the sweep it last ran (or submitted)
+    and, as failed, the points of it that did not complete (or have not
+    been seen completing). Points with values that were in that sweep
+    and not in failed are done, wherever they are in this sweep.
+    '''
+    if (record is None) or not('sweep' in record): return range(len(sweep))
+    if record['sweep']==sweep.spec: return list(iter_array(record.get('failed','')))
+    old = Sweep(record['sweep'],stage)
+    if (old.mode!=sweep.mode) or (old.names!=sweep.names): return range(len(sweep))
+    failed = set(iter_array(record.get('failed','')))
+    positions = [{str(v):i for i,v in enumerate(values)} for values in old.values]
+    todo = []
+    for k in range(len(sweep)):
+        coords = [pos.get(str(values[i]),None) for pos,values,i in zip(positions,sweep.values,sweep.coords(k))]
+        if None in coords: ko = None
+        elif old.mode=='zip': ko = coords[0] if len(set(coords))==1 else None
+        else: ko = sum([i*stride for i,stride in zip(coords,old.strides)])
+        if (ko is None) or (ko in failed): todo.append(k)
+    return todo
+
+def update_sweep_record(record,job_states,farm_failed_file=None):
+    '''Finds out which points of a submitted sweep failed, once all have finished
+
+    The points a sweep submitted are the failed ones of its record. Those
+    run by job arrays (the chunks of the record, each an array job ID and
+    the point of its task 0) failed unless their task COMPLETED, and
+    those run by a farm are listed in the farm_failed_file its job
+    writes. Returns COMPLETED or FAILED (and records the points that
+    failed), or None if some are still queued or running.
+    '''
+    todo = iter_array(record['failed'])
+    if record.get('farm',False):
+        if not(job_states.get(record['jobid'],None) in TERMINAL_STATES): return None
+        try:
+            with open(farm_failed_file,'r') as f:
+                failed = json.load(f)
+        except (OSError,ValueError):
+            failed = list(todo) # The farm did not get to the end
+    else:
+        failed = []
+        chunks = sorted(record['chunks'],key=lambda c: c[1])
+        c = 0
+        for i in todo:
+            while (c+1<len(chunks)) and (chunks[c+1][1]<=i): c += 1
+            state = job_states.get(f'{chunks[c][0]}_{i-chunks[c][1]}',None)
+            if not(state in TERMINAL_STATES): return None
+            if state!='COMPLETED': failed.append(i)
+    record['failed'] = format_array(failed)
+    return 'COMPLETED' if len(failed)==0 else 'FAILED'
+
+def get_sweep_fragments(sweep):
+    '''Shell-quoted options of each value of each list of a sweep, e.g. [['--lmax=1000','--lmax=2000'],...]'''
+    import argunparse
+    unparser = argunparse.ArgumentUnparser()
+    return [[' '.join([shlex.quote(w) for w in shlex.split(unparser.unparse(**{name: v}))]) for v in values]
+            for name,values in zip(sweep.names,sweep.values)]
+
+# Stands in for the label of a sweep point in the paths of its output
+SWEEP_LABEL = '{label}'
+
+def write_sweep_values(fname,sweep):
+    '''Writes the values of a sweep, one line each, for get_sweep_preamble()
+
+    The lines of each list follow those of the list before it, and have
+    the options and label part (e.g. lmax1000) of the value, shell-quoted.
+    '''
+    with open(fname,'w') as f:
+        for name,values,fragments in zip(sweep.names,sweep.values,get_sweep_fragments(sweep)):
+            for v,fragment in zip(values,fragments):
+                f.write(f"{shlex.quote(fragment)} {shlex.quote(f'{name}{v}')}\n")
+
+def get_sweep_preamble(sweep,values_file,offset,output_dir,out_file_root):
+    '''Shell commands that make a job array task run a point of a sweep
+
+    The task runs point SLURM_ARRAY_TASK_ID+offset. It works out which
+    value of each list that has like Sweep.coords() does, and reads
+    their options and labels from the values_file written by
+    write_sweep_values(). It then makes the output directory of the
+    point and exports it as MBATCH_OUTPUT_DIR, redirects its output like
+    get_array_preamble() does, and sets its options as "$@". output_dir
+    and out_file_root have SWEEP_LABEL in place of the label.
+    '''
+    def _path(path):
+        return '"$MBATCH_LABEL"'.join([shlex.quote(x) if x!='' else '' for x in path.split(SWEEP_LABEL)])
+    lines = ['',
+             '# mbatch sweep: each task runs point SLURM_ARRAY_TASK_ID+offset',
+             f'MBATCH_POINT=$((SLURM_ARRAY_TASK_ID+{offset}))',
+             'MBATCH_OPTIONS=""',
+             'MBATCH_LABEL=""']
+    first = 1
+    for values,stride in zip(sweep.values,sweep.strides if sweep.mode=='product' else [None]*len(sweep.values)):
+        k = 'MBATCH_POINT' if stride is None else f'MBATCH_POINT/{stride}%{len(values)}'
+        lines += [f'MBATCH_VALUE="$(sed -n "$(({k}+{first})){{p;q}}" {shlex.quote(values_file)})"',
+                  'eval "set -- $MBATCH_VALUE"',
+                  'MBATCH_OPTIONS="$MBATCH_OPTIONS $1"',
+                  'MBATCH_LABEL="${MBATCH_LABEL}_$2"']
+        first += len(values)
+    lines += ['MBATCH_LABEL="${MBATCH_LABEL#_}"',
+              f'export MBATCH_OUTPUT_DIR={_path(output_dir)}',
+              'mkdir -p "$MBATCH_OUTPUT_DIR"',
+              f'exec > {_path(out_file_root)}"_${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}.txt" 2>&1',
+              'eval "set -- $MBATCH_OPTIONS"',
+              '']
+    return '\n'.join(lines)
+
+# SLURM's default MaxArraySize
+DEFAULT_MAX_ARRAY_SIZE = 1001
+# Most nodes an allocation asks for, unless the site configuration or --max-nodes says otherwise
+DEFAULT_MAX_ALLOCATION_NODES = 16
+
+def get_max_array_size(sbatch_config,backend):
+    # The site configuration can set max_array_size, otherwise we ask the scheduler
+    size = sbatch_config.get('max_array_size',None)
+    if size is None: size = backend.get_max_array_size()
+    return int(size)
 
 def submit_slurm_core(template,name,cmd,nproc,cpn,threads,walltime,dry_run,output_dir,site,out_file_root,sbatch_file_root,
-                      depstr=None,account=None,qos=None,partition=None,constraint=None,threads_per_core=2,extra=''):
+                      depstr=None,account=None,qos=None,partition=None,constraint=None,threads_per_core=2,extra='',
+                      array=None,preamble='',backend=None):
 
     num_cores = nproc * threads
-    num_nodes = int(math.ceil(num_cores/cpn))
+    num_nodes = get_num_nodes(nproc,threads,cpn)
     totcores = num_nodes * cpn
     tasks_per_node = int(nproc*1./num_nodes)
     percent_used = num_cores*100./float(totcores)
@@ -282,11 +1465,13 @@ def submit_slurm_core(template,name,cmd,nproc,cpn,threads,walltime,dry_run,outpu
     template = template.replace('!PARTITION',_parse_none(partition,'partition'))
     template = template.replace('!OUT',out_file_root)
     template = template.replace('!EXTRA',extra)
+    if preamble!='': template = insert_preamble(template,preamble)
 
     if dry_run:
+        import html # The template can have characters like & and < that are not valid HTML
         fprint(HTML(f'<skyblue><b>{name}</b></skyblue>'))
         fprint(HTML(f'<skyblue><b>{"".join(["="]*len(name))}</b></skyblue>'))
-        fprint(HTML(f'<skyblue>{template}</skyblue>'))
+        fprint(HTML(f'<skyblue>{html.escape(template)}</skyblue>'))
     
     # Get current time in Unix milliseconds to define log directory
     init_time_ms = int(time.time()*1e3)
@@ -294,12 +1479,8 @@ def submit_slurm_core(template,name,cmd,nproc,cpn,threads,walltime,dry_run,outpu
     if not(dry_run):
         with open(fname,'w') as f:
             f.write(template)
-    cmds = []
-    cmds.append('sbatch')
-    cmds.append(f'--parsable')
-    if depstr is not None: cmds.append(f'{depstr}')
-    cmds.append(fname)
-    jobid = run_local(cmds,dry_run).strip()
+    if backend is None: backend = SlurmBackend()
+    jobid = backend.submit(fname,depstr=depstr,array=array,dry_run=dry_run)
     print(f"Submitted and obtained jobid {jobid}")
     return jobid
         
@@ -317,10 +1498,140 @@ def pretty_info(info):
         pstr = pstr + '\n' + f'\t{key:<10}{str(info[key]):<40}'
     return pstr
 
+@functools.lru_cache(maxsize=None)
+def get_packages_distributions():
+    # Scanning the metadata of every installed distribution is slow, so we only do it once
+    import importlib.metadata as metadata
+    return metadata.packages_distributions()
+
+def find_package(package):
+    '''Returns the directory and version of an installed package without importing it'''
+    import importlib.util,importlib.machinery
+    parts = package.split('.')
+    # find_spec() on a dotted name imports the parent packages, so we
+    # look up each submodule in the directories of its parent instead
+    try:
+        spec = importlib.util.find_spec(parts[0])
+    except (ImportError,ValueError):
+        spec = None
+    for i in range(1,len(parts)):
+        if (spec is None) or not(spec.submodule_search_locations):
+            spec = None
+            break
+        spec = importlib.machinery.PathFinder.find_spec('.'.join(parts[:i+1]),list(spec.submodule_search_locations))
+    if spec is None: raise_exception(f"Could not find package {package}.")
+    if spec.submodule_search_locations:
+        path = list(spec.submodule_search_locations)[0]
+    else:
+        path = os.path.dirname(spec.origin)
+    # The version of the distribution that installed the package, if any
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        return path, None
+    top = parts[0]
+    try:
+        dists = get_packages_distributions().get(top,[top])
+    except AttributeError: # Python < 3.10
+        dists = [top]
+    for dist in dists:
+        try:
+            return path, metadata.version(dist)
+        except metadata.PackageNotFoundError:
+            pass
+    return path, None
+
+def get_cache_dir():
+    cache_dir = os.environ.get('XDG_CACHE_HOME',os.path.join(os.path.expanduser('~'),'.cache'))
+    return os.path.join(cache_dir,'mbatch')
+
+def get_git_cache_filename():
+    return os.path.join(get_cache_dir(),'git_status.json')
+
+def get_git_status_key(repo,chash,others=()):
+    '''A key that changes whenever the dirty state of a work tree could have changed
+
+    This is the HEAD commit and the modification times of the index, of
+    every tracked file and of the directories containing them (which change
+    when an untracked file is created or removed). A file made inside an
+    untracked directory changes neither, so others should list the
+    untracked files and directories of the work tree (see get_git_status()),
+    and the directories under them are stat'ed too. This only needs a stat
+    of each file, which is much cheaper than diffing the work tree.
+    '''
+    root = repo.working_tree_dir
+    index_file = os.path.join(repo.git_dir,'index')
+    mtimes = [os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else 0]
+    dirs = set([root])
+    for (fpath,stage) in repo.index.entries.keys():
+        full = os.path.join(root,fpath)
+        try:
+            mtimes.append(os.lstat(full).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(-1)
+        d = os.path.dirname(fpath)
+        while not(d in dirs):
+            dirs.add(d)
+            d = os.path.dirname(d)
+    for d in dirs:
+        try:
+            mtimes.append(os.stat(os.path.join(root,d)).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(-1)
+    for other in others:
+        full = os.path.join(root,other)
+        if not(os.path.isdir(full)): continue
+        for dpath,dnames,fnames in os.walk(full):
+            try:
+                mtimes.append(os.stat(dpath).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(-1)
+    return get_fingerprint([chash,mtimes])
+
+_git_cache_lock = threading.Lock()
+
+def load_git_cache():
+    try:
+        with open(get_git_cache_filename(),'r') as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def get_git_status(repo,chash):
+    '''Returns whether a work tree has untracked files and uncommitted changes
+
+    Results are cached across invocations in get_git_cache_filename(), so
+    that the work tree is only walked again when it could have changed.
+    '''
+    root = repo.working_tree_dir
+    with _git_cache_lock:
+        cached = load_git_cache().get(root,None)
+    if (cached is not None) and (cached['key']==get_git_status_key(repo,chash,cached.get('others',[]))):
+        return cached['untracked'], cached['changes']
+    # Untracked files and directories (including empty ones, and collapsed
+    # to the top untracked directory), which the key has to watch as well
+    others = [o for o in repo.git.ls_files('-z','--others','--directory','--exclude-standard').split('\0') if o!='']
+    key = get_git_status_key(repo,chash,others)
+    untracked = len(repo.untracked_files)>0
+    changes = len(repo.index.diff(None))>0
+    # gitcheck() runs this from several threads, so the cache is
+    # re-read and updated under a lock
+    fname = get_git_cache_filename()
+    with _git_cache_lock:
+        cache = load_git_cache()
+        cache[root] = {'key': key, 'untracked': untracked, 'changes': changes, 'others': others}
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(fname+f'.{os.getpid()}.tmp','w') as f:
+                json.dump(cache,f)
+            os.replace(fname+f'.{os.getpid()}.tmp',fname)
+        except OSError:
+            pass # The cache is only an optimization
+    return untracked, changes
+
 # In actsims also currently, but this should be its final home
 def get_info(package=None,path=None,validate=True):
     import git
-    import importlib
     info = {}
     if package is None:
         if path is None:
@@ -328,13 +1639,8 @@ def get_info(package=None,path=None,validate=True):
         path = os.path.dirname(path)
         version = None
     else:
-        mod = importlib.import_module(package)
-        try:
-            version = mod.__version__
-        except AttributeError:
-            version = None
-        path = mod.__file__
-        path = os.path.dirname(path)
+        # Importing large packages just to find them can take seconds
+        path, version = find_package(package)
     info['package'] = package
     info['path'] = path
     info['version'] = version
@@ -346,8 +1652,7 @@ def get_info(package=None,path=None,validate=True):
     info['is_git'] = is_git
     if is_git:
         chash = str(repo.head.commit)
-        untracked = len(repo.untracked_files)>0
-        changes = len(repo.index.diff(None))>0
+        untracked, changes = get_git_status(repo,chash)
         branch = str(repo.active_branch)
         info['hash'] = chash
         info['untracked'] = untracked
@@ -379,35 +1684,54 @@ depdict = { 'a' : [ 'b', 'c', 'd'],
 
 has_loop() will check for dep loops in the dep dict with true or false.
 
+find_cycle() will return one such loop as a list of items, or None.
+
 flatten() will create an ordered list of items according to the dependency structure.
 
 Note:  To generate a list of dependencies in increasing order of dependencies, say for a build, run: flatten(MyDepDict)
 '''
 
-def _order(idepdict, val=None, level=0):
-    '''Generates a relative order in a dep dictionary'''
+def _order(idepdict):
+    '''Generates a relative order in an inverted dep dictionary
+
+    Each item is assigned a level equal to the length of the longest
+    chain of dependencies leading to it. Levels are computed with
+    Kahn's algorithm and the items are returned in depth-first
+    discovery order, so that both run in O(V+E).
+    '''
+    # Longest-path levels in topological order
+    indegree = {}
+    for k,v in idepdict.items():
+        indegree.setdefault(k,0)
+        for dep in v:
+            indegree[dep] = indegree.get(dep,0) + 1
+    levels = dict.fromkeys(indegree,0)
+    ready = [k for k,n in indegree.items() if n==0]
+    nseen = 0
+    while ready:
+        k = ready.pop()
+        nseen += 1
+        level = levels[k] + 1
+        for dep in idepdict.get(k,[]):
+            if level > levels[dep]: levels[dep] = level
+            indegree[dep] -= 1
+            if indegree[dep]==0: ready.append(dep)
+    if nseen!=len(indegree): raise ValueError("Dependency loop found while ordering.")
+
+    # Discovery order, iteratively walking the dependents of each item
     results = {}
-    if val is None:
-        for k,v in idepdict.items():
-            for dep in v:
-                results.setdefault(k,0)
-                d = _order(idepdict, val=dep, level=level+1)
-                for dk, dv in d.items():
-                    if dv > results.get(dk,0):
-                        results[dk] = dv
-        return results
-    else:
-        results[val] = level
-        deps = idepdict.get(val, None)
-        if deps is None or deps == []:
-            return { val: level }
-        else:
-            for dep in deps:
-                d = _order(idepdict, val=dep, level=level+1)
-                for dk, dv in d.items():
-                    if dv > results.get(dk,0):
-                        results[dk] = dv
-            return results
+    for k,v in idepdict.items():
+        if not(v) or k in results: continue
+        results[k] = levels[k]
+        stack = [iter(v)]
+        while stack:
+            dep = next(stack[-1],None)
+            if dep is None:
+                stack.pop()
+            elif not(dep in results):
+                results[dep] = levels[dep]
+                stack.append(iter(idepdict.get(dep,[])))
+    return results
 
 def _invert(d):
     '''Inverts a dictionary'''
@@ -416,14 +1740,10 @@ def _invert(d):
         try:
             iterator = iter(v)
         except TypeError:
-            depl = i.get(v, [])
-            depl.append(k)
-            i[v] = depl
+            i.setdefault(v, []).append(k)
         else:
             for dep in v:
-                depl = i.get(dep, [])
-                depl.append(k)
-                i[dep] = depl
+                i.setdefault(dep, []).append(k)
     return i
 
 def flatten(depdict):
@@ -444,32 +1764,120 @@ def flatten(depdict):
     return output
 
 
-def has_loop(depdict, seen=None, val=None):
+def find_cycle(depdict):
+    '''Find a dependency loop in a given depdict
+
+    Uses an iterative three-colour depth-first search, so it runs in
+    O(V+E) and is not limited by the recursion depth. Returns the loop
+    as a list of items that starts and ends with the same item
+    (e.g. ['a','b','a'] if a depends on b and b on a), or None if
+    there is no loop.
+    '''
+    WHITE, GREY, BLACK = 0, 1, 2
+    colour = {}
+    for root in depdict:
+        if colour.get(root,WHITE)!=WHITE: continue
+        colour[root] = GREY
+        path = [root]
+        stack = [iter(depdict.get(root,[]))]
+        while stack:
+            for dep in stack[-1]:
+                c = colour.get(dep,WHITE)
+                if c==WHITE:
+                    colour[dep] = GREY
+                    path.append(dep)
+                    stack.append(iter(depdict.get(dep,[])))
+                    break
+                elif c==GREY:
+                    return path[path.index(dep):] + [dep]
+            else:
+                colour[path.pop()] = BLACK
+                stack.pop()
+    return None
+
+def has_loop(depdict):
     '''Check to see if a given depdict has a dependency loop'''
-    if seen is None:
-        for k, v in depdict.items(): 
-            seen = []
-            for val in v: 
-                if has_loop(depdict, seen=list(seen), val=val):
-                    return True
-            
-    else:
-        if val in seen:
-            return True
-        else:
-            seen.append(val)
-            k = val
-            v = depdict.get(k,[])
-            for val in v:
-                if has_loop(depdict, seen=list(seen), val=val):
-                    return True
-    
-    return False            
-            
+    return find_cycle(depdict) is not None
+
 
 def raise_exception(message):
     fprint(HTML(f"<red>{message}</red>"))
     raise Exception
+
+# Audit events counted as filesystem operations by Profiler
+FS_AUDIT_EVENTS = set(['open','os.listdir','os.scandir','os.mkdir','os.remove','os.rename',
+                       'os.rmdir','os.chmod','shutil.copyfile','shutil.rmtree','glob.glob'])
+
+class Profiler(object):
+    '''Times the phases of main() when it is run with --profile
+
+    For each phase this records the wall time, the subprocesses launched
+    (by executable) and the number of filesystem operations, both counted
+    through an audit hook, and, if memory is True, the peak memory
+    allocated by python through tracemalloc. Tracing memory slows python
+    code down several times, so the times are only comparable between
+    runs that both did or did not trace memory. When not enabled, this
+    does nothing.
+    '''
+    def __init__(self,enabled=False,memory=False):
+        self.enabled = enabled
+        self.memory = memory
+        self.phases = {}
+        self.current = None
+        if not(enabled): return
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+        # Audit hooks can not be removed, but this only runs when asked for
+        sys.addaudithook(self._audit)
+        self.start = time.perf_counter()
+
+    def _audit(self,event,args):
+        if self.current is None: return
+        if event=='subprocess.Popen':
+            executable,cmds = args[0],args[1]
+            if executable is None: executable = cmds[0] if isinstance(cmds,(list,tuple)) else str(cmds).split()[0]
+            name = os.path.basename(str(executable))
+            subprocesses = self.phases[self.current]['subprocesses']
+            subprocesses[name] = subprocesses.get(name,0) + 1
+        elif event in FS_AUDIT_EVENTS:
+            self.phases[self.current]['fs_ops'] += 1
+
+    def phase(self,name):
+        '''Ends the current phase (if any) and starts the one called name (unless it is None)'''
+        if not(self.enabled): return
+        import tracemalloc
+        now = time.perf_counter()
+        if self.current is not None:
+            record = self.phases[self.current]
+            record['seconds'] += now - self.phase_start
+            if self.memory: record['peak_mb'] = max(record['peak_mb'],tracemalloc.get_traced_memory()[1]/1e6)
+        self.current = name
+        if name is None: return
+        # A phase can be entered more than once
+        if not(name in self.phases):
+            self.phases[name] = {'seconds': 0., 'subprocesses': {}, 'fs_ops': 0,
+                                 'peak_mb': 0. if self.memory else None}
+        if self.memory and hasattr(tracemalloc,'reset_peak'): tracemalloc.reset_peak() # Python >= 3.9
+        self.phase_start = now
+
+    def report(self,fname):
+        '''Prints a table of the phases and saves them to fname as JSON'''
+        if not(self.enabled): return
+        self.phase(None)
+        total = time.perf_counter() - self.start
+        print(f"{'PHASE':<16}{'SECONDS':>10}{'FS OPS':>10}{'PEAK MB':>10}  SUBPROCESSES")
+        for name,record in self.phases.items():
+            subprocesses = ', '.join([f'{k} x{v}' for k,v in record['subprocesses'].items()])
+            peak = f"{record['peak_mb']:>10.1f}" if self.memory else f"{'-':>10}"
+            print(f"{name:<16}{record['seconds']:>10.3f}{record['fs_ops']:>10d}{peak}  {subprocesses}")
+        print(f"{'total':<16}{total:>10.3f} (including time waiting for confirmation)")
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname,'w') as f:
+            json.dump({'total_seconds': total,
+                       'peak_mb': max([0.]+[record['peak_mb'] for record in self.phases.values()]) if self.memory else None,
+                       'phases': self.phases},f,indent=1)
+        print(f"Saved profile to {fname}")
     
 
 """
@@ -477,27 +1885,41 @@ Caching
 
 We take a conservative approach to caching and reusing.
 In order for a stage to be reused, four conditions have to be met:
-1. There must be a SLURM output file (or local equivalent) that
-clearly indicates that the most recent job was completed successfully
-2. There must be a saved configuration file in the directory
-that perfectly matches the submitted config for that stage
+1. The index of the project must show that the most recent
+job of that stage was completed successfully
+2. The fingerprint (content hash) of the config of that
+stage, its script and the local modules the script imports
+must match the one recorded when it was submitted
 3. Git hashes and package versions should match (this can be overriden)
 4. it must not depend on a stage that is not going to be reused
 
+When jobs are submitted, we record their jobid, submission time and
+fingerprints in the index (mbatch_index.json in the project directory).
+We also save a config file for that stage in its directory as a log.
+
 To do 1:
-1. we search for get_out_file_root()* in the output directory and pick the last one
-2. we extract the jobid from that
-3. we run
-sacct -j JOBID --format=State --parsable2
-4. This should return
-State
-COMPLETED
-COMPLETED
+1. we collect the jobids of all SLURM jobs in the index that had not
+finished the last time we checked, and run (in chunks if there are many)
+sacct -X -P --noheader -j JOBID1,JOBID2,... --format=JobID,State
+2. This should return
+JOBID1|COMPLETED
+JOBID2|FAILED
 ...
-or something like that. We check that this is the case. Make sure this is sufficient by looking at niagara history.
+and we record terminal states like these in the index, so that
+these jobs are never queried again.
+3. Local runs are recorded as COMPLETED when they finish.
 
-To do 2:
-When jobs are submitted, we save a config file for that section there and check against it.
+If a project has no index yet (it was run with an older mbatch), we
+instead search for get_out_file_root()* and get_local_out_file()* in the
+output directories, pick the last ones, and rebuild the index from them.
+
+To do 2 and 3:
+We compare get_stage_fingerprints() and the hash of the git information
+with those in the index. Packages are located (and their versions
+read from their installed metadata) without importing them. Whether
+a git work tree has uncommitted changes is cached in
+get_git_cache_filename() and only checked again when the HEAD commit
+or the modification time of a tracked file or directory changes.
 
 
 During submissions, we just need to show a summary like
@@ -527,6 +1949,31 @@ def main():
     parser.add_argument("--force-local", action='store_true',help='Force local run.')
     parser.add_argument("--force-slurm", action='store_true',help="Force SLURM. "
                         "If SLURM is not detected and --dry-run is not enabled, this will fail.")
+    parser.add_argument("--emulate", action='store_true',help="Run the SLURM jobs on this machine with a local emulator of SLURM "
+                        "instead of submitting them with sbatch. mbatch then waits for them to finish.")
+    parser.add_argument("--allocation", action='store_true',help="Run the stages as steps of one SLURM allocation instead of "
+                        "submitting a job for each. If not run inside an allocation (e.g. from salloc), this submits one job with "
+                        "enough nodes for the widest level of the pipeline, which runs mbatch again to launch the stages.")
+    parser.add_argument("--max-nodes", type=int, default=None,help="Most nodes the job submitted by --allocation asks for. Stages that "
+                        "don't fit run in turns. Defaults to max_allocation_nodes in the site configuration, or "
+                        f"{DEFAULT_MAX_ALLOCATION_NODES}.")
+    parser.add_argument("-y","--yes", action='store_true',help="Proceed without asking for confirmation.")
+    parser.add_argument("--local-cores", type=int, default=None,help="Number of cores to run local stages on at the same time. "
+                        "Defaults to the number of cores of this machine.")
+    parser.add_argument("--local-memory-gb", type=float, default=None,help="Memory in GB that local stages can use at the same time. "
+                        "Defaults to the memory of this machine.")
+    parser.add_argument("--mpirun", type=str, default=None,help="Command to launch the MPI processes of local stages with, e.g. "
+                        "'mpirun --oversubscribe'. Defaults to mpirun or mpiexec, whichever is found first.")
+    parser.add_argument("--no-echo", action='store_true',help="Don't show the output of local stages as they run. "
+                        "It is still saved to local_log_* files in their output directories.")
+    parser.add_argument("--no-array", action='store_true',help="Submit each iteration of a looped stage as a separate SLURM job "
+                        "instead of as one job array. The points of a sweep are always submitted as job arrays (or a farm).")
+    parser.add_argument("--no-fuse", action='store_true',help="Submit each stage of a chain (in which each stage only depends on "
+                        "the one before it, which nothing else depends on) with the same parallel settings as a separate "
+                        "SLURM job instead of as one job.")
+    parser.add_argument("--no-output-hash", action='store_true',help="Don't read and hash the outputs of completed stages that others "
+                        "depend on. Stages are then not checked for having been run on outputs that have since changed, and local "
+                        "stages are not reused when the stages they depend on reproduce their outputs.")
     parser.add_argument('--skip', nargs='+', help='List of stages to skip, separated by space. These stages will be skipped even if others depend on them.')
     parser.add_argument("-A","--account", type=str,  default=None,help='sbatch account argument. e.g. on NERSC, use this to select the account that is charged.')
     parser.add_argument("-q", "--qos",     type=str,  default=None,help="QOS name")
@@ -534,6 +1981,10 @@ def main():
     parser.add_argument("-c", "--constraint",     type=str,  default=None,help="Constraint name")
     parser.add_argument("-e", "--extra",     type=str,  default='',help="Extra commands to run in SLURM batch script, e.g. to load a specific virtual environment.")
     parser.add_argument("--show-site-path", action='store_true',help='Show path to site configs and exit without doing anything else.')
+    parser.add_argument("--profile", action='store_true',help='Report the time, subprocesses and filesystem operations used by each phase '
+                        'of planning and submission, and save this to mbatch_profile.json in the project directory.')
+    parser.add_argument("--profile-memory", action='store_true',help='Like --profile, but also report the peak memory used by each phase. '
+                        'This makes mbatch itself several times slower.')
     args = parser.parse_args()
 
     if args.show_site_path:
@@ -544,7 +1995,11 @@ def main():
     
     if args.force_local and args.force_slurm: raise_exception("You can\'t force both local and SLURM.")
 
+    prof = Profiler(args.profile or args.profile_memory,memory=args.profile_memory)
+
     # Load config file
+    prof.phase('load config')
+    import yaml
     with open(args.config_yaml, 'r') as stream:
         config = yaml.safe_load(stream)
 
@@ -552,15 +2007,23 @@ def main():
     root_dir = config['root_dir']
     
     # Check if we have SLURM
-    have_slurm = check_slurm()
+    if args.emulate:
+        if args.force_local: raise_exception("You can\'t both emulate SLURM and force a local run.")
+        from mbatch.emulator import EmulatorBackend
+        backend = EmulatorBackend()
+        have_slurm = True
+    else:
+        backend = SlurmBackend()
+        have_slurm = check_slurm()
     if not(have_slurm):
         print("No SLURM detected. We will be locally "
-              "executing commands serially.")
+              "executing commands, in parallel where possible.")
     if args.dry_run:
         print("We are doing a dry run, so we will just print to "
               "screen.")
 
     # Do git checks
+    prof.phase('git checks')
     pkg_gitdict = gitcheck(config,'gitcheck_pkgs',package=True)
     pth_gitdict = gitcheck(config,'gitcheck_paths',package=False)
 
@@ -569,59 +2032,31 @@ def main():
 
     # Get stages in order of dependencies
     cstages = config['stages']
-    stage_names = list(cstages.keys())
 
     # Unroll loops from cstags into ostages
-    cstages = config['stages']
-    ostages = {} # Unrolled stage dictionary
-    unroll_map = {} # dict mapping parent stage name to list of unrolled iterated stage names
-    for stage in stage_names:
-        # Check if this is a looped stage
-        if ('arg' in cstages[stage]):
-            if (type(cstages[stage]['arg'])) in [list,tuple]:
-                unroll_map[stage] = []
-                for k,arg in enumerate(cstages[stage]['arg']):
-                    if len(shlex.split(arg))>1: raise Exception("Argument should not be interpretable as multiple arguments.")
-                    new_stage_name = f'{stage}_{arg}'
-                    if new_stage_name in stage_names:
-                        raise_exception(f"Internal loop stage name "
-                                        "clashes with {stage}_!loop_iteration_{k}. "
-                                        "Please use a different stage name.")
-                    ostages[new_stage_name] = copy.deepcopy(cstages[stage])
-                    del ostages[new_stage_name]['arg']
-                    ostages[new_stage_name]['arg'] = cstages[stage]['arg'][k]
-                    unroll_map[stage].append(new_stage_name)
-            else:
-                if len(shlex.split(cstages[stage]['arg']))>1: raise Exception("Argument should not be interpretable as multiple arguments.")
-                ostages[stage] = copy.deepcopy(cstages[stage])
-        else:
-            ostages[stage] = copy.deepcopy(cstages[stage])
-
+    prof.phase('unroll')
+    ostages, unroll_map = unroll_stages(cstages)
     stage_names = list(ostages.keys())
+
     # Map dependencies
-    deps = {} # Mapping from stage to its dependencies
-    depended = [] # List of stages that are depended on
-    for sname in stage_names:
-        ds = ostages[sname].get('depends')
-        if ds is None: continue
-        my_deps = []
-        for d in ds:
-            if not(d in stage_names) and not(d in unroll_map):
-                raise_exception(f"Stage {d} required by {sname} not found in configuration file.")
-            if d in unroll_map:
-                my_deps = my_deps + unroll_map[d]
-            else:
-                my_deps.append(d)
-        depended = depended + my_deps
-        deps[sname] = my_deps
+    prof.phase('dependencies')
+    deps, depended = map_dependencies(ostages, unroll_map)
 
-    if has_loop(deps): raise_exception("Circular dependency detected.")
+    prof.phase('flatten')
+    cycle = find_cycle(deps)
+    if cycle is not None: raise_exception(f"Circular dependency detected: {' -> '.join(cycle)}.")
     stages = flatten(deps) # Ordered by dependency
     # The above only contains stages that depend on something or something also depends on
     # Let's just append any others and warn about them
+    ordered = set(stages)
+    warned = set()
     for ostage in stage_names:
-        if ostage not in stages:
-            fprint(HTML(f"<ansiyellow>WARNING: stage {ostage} does not depend on anything, and nothing depends on it. Adding to queue anyway...</ansiyellow>"))
+        if ostage not in ordered:
+            # Once for a looped stage or sweep rather than for each of its iterations
+            name = ostages[ostage].parent or ostage
+            if name not in warned:
+                fprint(HTML(f"<ansiyellow>WARNING: stage {name} does not depend on anything, and nothing depends on it. Adding to queue anyway...</ansiyellow>"))
+                warned.add(name)
             stages.append(ostage)
     if set(stages)!=set(stage_names): raise_exception("Internal error in arranging stages. Please report this bug.")
 
@@ -631,131 +2066,238 @@ def main():
         if not(skipstage in stages): raise_exception("Asked to skip a stage that is not in the list of stages.")
     
     # Parse arguments and prepare SLURM scripts
-
-    if have_slurm or args.force_slurm:
+    prof.phase('site')
+    if args.emulate:
+        site = backend.name
+        sbatch_config = backend.get_site_config()
+    elif have_slurm or args.force_slurm:
         site = detect_site() if args.site is None else args.site
         sbatch_config = load_template(site)
     else:
         site = 'local'
 
     ###########################
-    reuse_stages = []
+    reuse_stages = set()
+
+    # Content hashes that decide whether a previous submission can be reused
+    prof.phase('fingerprints')
+    fingerprints = get_stage_fingerprints(ostages,global_vals)
+    git_fingerprints = get_git_fingerprints(ostages,pkg_gitdict,pth_gitdict)
+
+    # The index of the project records the last submission of each stage
+    prof.phase('index')
+    index = load_index(root_dir,args.project)
+    if index is None:
+        # (sweeps are newer than the index)
+        index = {'stages': scan_project_history(root_dir,args.project,[s for s in stages if ostages[s].sweep is None],
+                                                site,global_vals,backend=backend)}
+    records = index['stages']
+    partial_sweeps = set() # Sweeps that only need to run the points that did not complete
 
     if not(args.no_reuse):
         # We decide which ones to resume here
-        last_time = 0
-        last_time_local = 0
-        last_job = None
-        last_job_local = None
+        # First update the states of SLURM jobs that had not finished when last checked
+        prof.phase('job states')
+        pending = []
+        for stage in stages:
+            record = records.get(stage,None)
+            if (record is None) or (record['site']!=site) or (record['status'] in TERMINAL_STATES): continue
+            # Asking about a job array gets the states of its tasks
+            pending += [c[0] for c in record['chunks']] if 'chunks' in record else [record['jobid']]
+        allocations = index.get('pending',{})
+        pending = pending + [a['jobid'] for a in allocations.values() if a['site']==site]
+        job_states = backend.get_job_states(list(set(pending))) if len(pending)>0 else {}
+        prof.phase('output hashes')
+        nupdated = 0
+        # An allocation job that has finished recorded whatever it ran itself
+        for stage in list(allocations.keys()):
+            if (allocations[stage]['site']==site) and (job_states.get(allocations[stage]['jobid'],None) in TERMINAL_STATES):
+                del allocations[stage]
+                nupdated += 1
+        to_hash = []
+        for stage in stages:
+            record = records.get(stage,None)
+            if record is None: continue
+            if 'sweep' in record:
+                # A sweep has finished once all the points it submitted have
+                state = None
+                if (record['site']==site) and not(record['status'] in TERMINAL_STATES):
+                    farm_failed_file = os.path.join(get_output_dir(root_dir,stage,args.project),
+                                                    f"farm_failed_{stage}_{args.project}_{record['jobid']}.json")
+                    state = update_sweep_record(record,job_states,farm_failed_file)
+            else:
+                state = job_states.get(record['jobid'],None)
+            if (state in TERMINAL_STATES) and record.get('marked',False):
+                # A stage of a fused job (or an iteration in a farm) completed
+                # if it got to write its marker, whether or not the others did
+                if os.path.exists(get_slurm_state_file(root_dir,stage,args.project)+f"_{record['jobid']}.txt"): state = 'COMPLETED'
+                elif state=='COMPLETED': state = 'FAILED'
+            if state in TERMINAL_STATES:
+                record['status'] = state
+                nupdated += 1
+            # Record what completed stages wrote if others depend on them...
+            if (record['status']=='COMPLETED') and (stage in depended) and not('output_hash' in record) and not(args.no_output_hash):
+                to_hash.append(stage)
+        for stage in [s for s in to_hash if 'sweep' in records[s]]:
+            records[stage]['output_hash'] = get_sweep_output_hash(root_dir,stage,args.project,Sweep(records[stage]['sweep'],stage))
+            nupdated += 1
+        to_hash = [s for s in to_hash if not('sweep' in records[s])]
+        for stage,output_hash in zip(to_hash,get_output_hashes([get_output_dir(root_dir,stage,args.project) for stage in to_hash])):
+            records[stage]['output_hash'] = output_hash
+            nupdated += 1
+        # ...and what they read, now that we know their inputs were produced
+        for stage in stages:
+            record = records.get(stage,None)
+            if (record is None) or (record['status']!='COMPLETED') or not('inputs' in record): continue
+            inputs = record.pop('inputs')
+            resolved = all([(d in records) and (records[d]['jobid']==jobid) for d,jobid in inputs.items()])
+            record['input_hash'] = get_input_hash(list(inputs.keys()),records) if resolved else None
+            nupdated += 1
+        if nupdated>0: save_index(root_dir,args.project,index)
+
+        prof.phase('reuse')
         for stage in stages:
             print(f"Checking {stage}...")
             # We check if the last submitted job (if it exists) was completed
-            # TODO: add check for local runs, not just sbatch
-            root = get_out_file_root(root_dir,stage,args.project,site) + "_"
-            suffix = ".txt"
-            fs = glob.glob(root + "*" + suffix)
-            if len(fs)==0:
-                completed = False
-                print("No output file found")
-            else:
-                last_job = max([sint(re.search(rf'{root}(.*?){suffix}', f).group(1)) for f in fs])
-                output = run_local(['sacct', '-j',
-                                           str(last_job), '--format=State',
-                                           '--parsable2'],
-                                          verbose=False).split('\n')
-                completed = True
-                for i,line in enumerate(output):
-                    if i==0:
-                        if line.strip()!='State': raise_exception("Unexpected output from sacct.")
-                    elif i==(len(output)-1):
-                        if line.strip()!='': raise_exception("Unexpected output from sacct.")
-                    else:
-                        if line.strip()!='COMPLETED':
-                            completed = False
-                            print("COMPLETED string not found")
-                            break
-                            
-            if completed:
-                # Get time, to compare with possible completed local run
-                with open(get_stage_config_filename(root_dir,stage,args.project,last_job), 'r') as stream:
-                    last_time = yaml.safe_load(stream)['stage']['time']
-
-
-            # Also check for local run completed outputs
-            root = get_local_out_file(root_dir,stage,args.project) + "_"
-            suffix = ".txt"
-            fs = glob.glob(root + "*" + suffix)
-            completed_local = False
-            if len(fs)!=0:
-                last_job_local = max([sint(re.search(rf'{root}(.*?){suffix}', f).group(1)) for f in fs])
-                with open(get_local_out_file(root_dir,stage,args.project)+f"_{last_job_local}.txt",'r') as f:
-                    cstatus = f.read().strip()
-                if cstatus=='COMPLETED':
-                    completed_local = True
-                    with open(get_stage_config_filename(root_dir,stage,args.project,last_job_local), 'r') as stream:
-                        last_time_local = yaml.safe_load(stream)['stage']['time']
-            
-            if completed or completed_local:
-                last_job = [last_job,last_job_local][argmax([last_time,last_time_local])]
-                if last_job is None: raise_exception("Error in last completed job detection. Report bug.")
-            else:
+            record = records.get(stage,None)
+            if (record is None) or not(record['site'] in [site,'local']):
+                print("No previous submission found")
+                continue
+            if (record['status']!='COMPLETED') and (ostages[stage].sweep is None):
+                print("COMPLETED state not found")
+                continue
+            # (the allocation job running this is the only one that may reuse it)
+            if (stage in allocations) and (allocations[stage]['jobid']!=os.environ.get('SLURM_JOB_ID',None)):
+                print("An allocation job that will run this stage has not finished")
                 continue
 
-            # Next check if dictionaries match
-            try:
-                with open(get_stage_config_filename(root_dir,stage,args.project,last_job), 'r') as stream:
-                    saved_config = yaml.safe_load(stream)
-            except:
-                fprint(HTML(f"<ansiyellow>Could not find saved configuration for {stage} even though completed job was detected. Will not re-use this stage.</ansiyellow>"))
+            # The outputs of the stage (or the record of what made them) may have
+            # been deleted since
+            if not(os.path.isdir(get_output_dir(root_dir,stage,args.project))) or \
+               not(os.path.isfile(get_stage_config_filename(root_dir,stage,args.project,record['jobid']))):
+                print("Output directory or saved configuration not found; not reusing")
+                continue
+
+            # Next check if the configurations match
+            if record.get('fingerprint',None)!=fingerprints[stage]:
+                print("Configuration changed; not reusing")
                 continue
-            # We don't need to make sure the parallel options are the same
-            saved_config['stage'][stage].pop('parallel', None)
-            comp_dict = copy.deepcopy(ostages[stage])
-            comp_dict.pop('parallel', None)
-            # TODO: make sure this comparison of nested dictionaries is sufficient
-            if saved_config['stage'][stage]!=comp_dict: continue
 
             # Next we check if there are git differences
             if not(args.ignore_git):
-                if saved_config['stage']['pkg_gitdict']!=pkg_gitdict: 
-                    print(saved_config['stage']['pkg_gitdict'])
-                    print(pkg_gitdict)
-                    print("Package git changed; not reusing")
+                if record.get('git_fingerprint',None)!=git_fingerprints[stage]:
+                    print("Package or path git changed; not reusing")
                     continue
-                if saved_config['stage']['pth_gitdict']!=pth_gitdict: 
-                    print("Path git changed; not reusing")
+
+            # The points of a sweep that completed don't need to be run again
+            if ostages[stage].sweep is not None:
+                partial_sweeps.add(stage)
+                if (record['status']!='COMPLETED') or (record.get('sweep',None)!=ostages[stage].sweep.spec):
+                    print("The sweep changed or not all of its points completed; running the others")
                     continue
 
             # We made it this far, which means this stage can be reused
-            reuse_stages.append(stage)
+            reuse_stages.add(stage)
 
     ###########################
 
     is_sbatch = (have_slurm or args.force_slurm) and not(args.force_local)
     is_local = not(have_slurm) or args.force_local
     if sum([int(x) for x in [is_sbatch,is_local]])!=1: raise_exception("Inconsistency in submission vs. local. Report bug.")
+    if args.allocation and not(is_sbatch): raise_exception("An allocation needs SLURM.")
+    # With --allocation, we submit one job that runs mbatch again, and that
+    # (or a run from inside salloc) runs the stages as steps of its allocation
+    in_allocation = args.allocation and ('SLURM_JOB_ID' in os.environ)
     
     # Check if any reused stages have dependencies that are not reused
-    # If so we will not reuse those stages
+    # If so we will not reuse those stages, unless (for local runs) the
+    # dependencies turn out to produce the same outputs as before
     # Algorithm is linear since `stages` is already sorted
+    cutoff_stages = set()
     for stage in stages:
         if stage in reuse_stages:
             if not(stage in deps): continue
             redo = False
             for d in deps[stage]:
                 if not(d in reuse_stages) and not(d in args.skip): redo = True
-            if redo: reuse_stages.remove(stage)
+            if redo:
+                reuse_stages.remove(stage)
+                if is_local or in_allocation: cutoff_stages.add(stage)
+                continue
+            # Dependencies that were re-run since this stage ran make it stale
+            input_hash = records[stage].get('input_hash',None)
+            if (input_hash is not None) and (get_input_hash(deps[stage],records) not in [None,input_hash]):
+                print(f"Outputs of stages that {stage} depends on have changed; not reusing")
+                reuse_stages.remove(stage)
+
+    # The points that each sweep runs: only those that did not complete if
+    # it ran on the same inputs as now, and all of them otherwise
+    sweep_todo = {}
+    for stage in stages:
+        sweep = ostages[stage].sweep
+        if (sweep is None) or (stage in reuse_stages) or (stage in args.skip): continue
+        sweep_todo[stage] = range(len(sweep))
+        if not(stage in partial_sweeps): continue
+        if any([not(d in reuse_stages) and not(d in args.skip) for d in deps.get(stage,[])]): continue
+        record = records[stage]
+        if 'inputs' in record:
+            if any([records.get(d,{}).get('jobid',None)!=jobid for d,jobid in record['inputs'].items()]): continue
+        elif (record.get('input_hash',None) is not None) and (get_input_hash(deps.get(stage,[]),records) not in [None,record['input_hash']]): continue
+        sweep_todo[stage] = get_sweep_todo(sweep,record,stage)
             
+    # Chains of stages with the same parallel settings are submitted as one
+    # job that runs them one after another
+    def _can_fuse(first,second):
+        def _parallel(stage):
+            return {k:v for k,v in (ostages[stage].get('parallel',None) or {}).items() if k!='walltime'}
+        for stage in [first,second]:
+            if (stage in args.skip) or (stage in reuse_stages): return False
+            if (ostages[stage].parent is not None) and (ostages[stage].get('farm',False) or not(args.no_array)): return False
+            if ostages[stage].sweep is not None: return False
+        return _parallel(first)==_parallel(second)
+    if is_sbatch and not(args.allocation) and not(args.no_fuse):
+        chains = get_fusable_chains(stages,deps,_can_fuse)
+    else:
+        chains = {}
+    if args.allocation:
+        # An allocation launches each iteration or point as a step of its own
+        farmed = sorted(set([ostages[stage].parent or stage for stage in stages if ostages[stage].get('farm',False) and
+                             not(stage in args.skip) and not(stage in reuse_stages)]))
+        if len(farmed)>0: raise_exception(f"farm is not supported with --allocation (stages {', '.join(farmed)}). "
+                                          "Set farm: false for them, or submit without --allocation.")
+
     # A summary and a prompt
+    prof.phase('summary')
     print(f"SUMMARY FOR SUBMISSION OF PROJECT {args.project}")
     for stage in stages:
+        if stage in sweep_todo:
+            npoints = len(ostages[stage].sweep)
+            sumtxt = '<green>[SUBMIT*]</green>' if stage in cutoff_stages else '<green>[SUBMIT]</green>'
+            if len(sweep_todo[stage])<npoints: sumtxt = sumtxt + f' {len(sweep_todo[stage])} of {npoints} points'
+            else: sumtxt = sumtxt + f' {npoints} points'
+            fprint(HTML(stage+'\t\t'+sumtxt))
+            continue
         if stage in reuse_stages:
             sumtxt='<red><b>[REUSE]</b></red>'
         elif stage in args.skip: sumtxt='<red><b>[SKIP]</b></red>'
+        elif stage in cutoff_stages: sumtxt='<green>[SUBMIT*]</green>'
         else: sumtxt='<green>[SUBMIT]</green>'
         fprint(HTML(stage+'\t\t'+sumtxt))
-
-    reply = query_yes_no("Proceed with this?")
+    if len(cutoff_stages)>0:
+        print("* These will be reused if the stages they depend on reproduce their previous outputs.")
+    for chain in chains.values():
+        print(f"Stages {', '.join(chain)} will run one after another in one job.")
+    if is_sbatch and not(args.allocation):
+        for parent,members in unroll_map.items():
+            nfarm = len([s for s in members if not(s in args.skip) and not(s in reuse_stages)])
+            if cstages[parent].get('farm',False) and nfarm>0:
+                print(f"{nfarm} iteration(s) of {parent} will run in one MPI task farm.")
+        for stage,todo in sweep_todo.items():
+            if cstages[stage].get('farm',False) and len(todo)>0:
+                print(f"{len(todo)} point(s) of {stage} will run in one MPI task farm.")
+
+    prof.phase(None)
+    reply = args.yes or query_yes_no("Proceed with this?")
     if not(reply):
         sys.exit(0)
 
@@ -764,43 +2306,286 @@ def main():
     proj_dir = get_project_dir(root_dir,args.project)
     os.makedirs(proj_dir, exist_ok=True)
 
+    prof.phase('submission')
     jobids = {}
-    for stage in stages:
-        if stage in args.skip:
-            fprint(HTML(f"<ansiyellow>Skipping stage {stage} as requested.</ansiyellow>"))
-            if stage in depended: fprint(HTML(f"<ansiyellow>WARNING: skipped stage {stage} is depended on by others.</ansiyellow>"))
-            continue
-        if stage in reuse_stages:
-            fprint(HTML(f"<ansiyellow>Reusing stage {stage} as requested.</ansiyellow>"))
-            if stage in depended: fprint(HTML(f"<ansiyellow>WARNING: reused stage {stage} is depended on by others.</ansiyellow>"))
-            continue
-
-        # Get command
-        execution,script,pargs = get_command(global_vals, copy.deepcopy(ostages), stage)
+    depids = {} # jobids that dependent stages wait on; the whole job array for loop iterations
+    local_cmds = {} # local stages (and steps of an allocation) are run together once we know all of them
+    sweep_nodes = {} # the points of each sweep in local_cmds, which are run like stages of their own
+    node_stage = {} # and the sweep and index of each of those points
+    try:
+        for stage in stages:
+            if stage in jobids: continue # Already submitted as part of a job array
+            if stage in args.skip:
+                fprint(HTML(f"<ansiyellow>Skipping stage {stage} as requested.</ansiyellow>"))
+                if stage in depended: fprint(HTML(f"<ansiyellow>WARNING: skipped stage {stage} is depended on by others.</ansiyellow>"))
+                continue
+            if stage in reuse_stages:
+                fprint(HTML(f"<ansiyellow>Reusing stage {stage} as requested.</ansiyellow>"))
+                if stage in depended: fprint(HTML(f"<ansiyellow>WARNING: reused stage {stage} is depended on by others.</ansiyellow>"))
+                continue
 
-        # Make output directory
-        output_dir =  get_output_dir(root_dir,stage,args.project)
-        os.makedirs(output_dir, exist_ok=True)
+            if (stage in sweep_todo) and (len(sweep_todo[stage])==0):
+                # All the points are done, but the sweep is not the one that
+                # ran them (e.g. values were removed), so it gets a new record
+                output_dir = get_output_dir(root_dir,stage,args.project)
+                os.makedirs(output_dir, exist_ok=True)
+                jobid = get_local_jobid()
+                if not(args.dry_run):
+                    records[stage] = get_index_record(jobid,'local','COMPLETED',fingerprints[stage],git_fingerprints[stage])
+                    records[stage]['sweep'] = ostages[stage].sweep.spec
+                    records[stage]['failed'] = ''
+                    records[stage]['inputs'] = {d: records[d]['jobid'] for d in deps.get(stage,[]) if d in records}
+                    save_stage_config(root_dir,stage,args.project,records[stage],ostages[stage],pkg_gitdict,pth_gitdict)
+                jobids[stage] = jobid
+                continue
 
+            if is_local or args.allocation:
+                execution,script,pargs = get_command(global_vals, ostages, stage)
+                output_dir =  get_output_dir(root_dir,stage,args.project)
+                os.makedirs(output_dir, exist_ok=True)
+                if stage in sweep_todo:
+                    # Each point is run on its own, like an iteration of a loop
+                    sweep = ostages[stage].sweep
+                    fragments = get_sweep_fragments(sweep)
+                    sweep_nodes[stage] = []
+                    for k in sweep_todo[stage]:
+                        coords = sweep.coords(k)
+                        point = f'{stage}_{sweep.get_label(k)}'
+                        point_dir = get_output_dir(root_dir,point,args.project)
+                        os.makedirs(point_dir, exist_ok=True)
+                        options = ' '.join([fragments[j][i] for j,i in enumerate(coords)]).strip()
+                        local_cmds[point] = [execution,script] + [c for c in [pargs,options] if c!=''] + ['--output-dir',point_dir]
+                        sweep_nodes[stage].append(point)
+                        node_stage[point] = (stage,k)
+                    continue
+                if pargs=='':
+                    local_cmds[stage] = [execution,script, '--output-dir',output_dir]
+                else:
+                    local_cmds[stage] = [execution,script, pargs, '--output-dir',output_dir]
+                continue
 
-        # Construct dependency string
-        now_deps = deps.get(stage,[])
-        if len(now_deps)>=1:
-            jlist = []
-            for s in now_deps:
-                if not(s in args.skip) and not(s in reuse_stages):
-                    jlist.append(jobids[s])
-            if len(jlist)>=1:
-                depstr = ':'.join(jlist)
-                depstr = "--dependency=afterok:" + depstr
+            # Construct dependency string
+            now_deps = deps.get(stage,[])
+            if len(now_deps)>=1:
+                jlist = {}
+                for s in now_deps:
+                    if not(s in args.skip) and not(s in reuse_stages) and (depids.get(s,None) is not None):
+                        jlist[depids[s]] = None
+                if len(jlist)>=1:
+                    depstr = ':'.join(jlist)
+                    depstr = "--dependency=afterok:" + depstr
+                else:
+                    depstr = None
             else:
                 depstr = None
-        else:
-            depstr = None
-        
-        if is_sbatch:
+
+            # Submit a chain of stages as one job
+            if stage in chains:
+                chain = chains[stage]
+                constraint = get_default(sbatch_config,'constraint',args.constraint)
+                partition = get_default(sbatch_config,'part',args.partition)
+                nproc,threads,walltime = get_stage_parallel(stage,sbatch_config,ostages[stage].get('parallel',None),constraint,partition)
+                seconds = 0
+                for s in chain:
+                    swall = parse_walltime(get_stage_parallel(s,sbatch_config,ostages[s].get('parallel',None),constraint,partition)[2])
+                    seconds = None if (seconds is None) or (swall is None) else seconds + swall
+                cmds = []
+                for s in chain:
+                    execution,script,pargs = get_command(global_vals, ostages, s)
+                    output_dir = get_output_dir(root_dir,s,args.project)
+                    os.makedirs(output_dir, exist_ok=True)
+                    cmds.append(' '.join([execution,script,pargs]) + f' --output-dir {output_dir}')
+                template = get_fused_template(sbatch_config['template'],cmds,
+                                              [get_out_file_root(root_dir,s,args.project,site)+'_${SLURM_JOB_ID}.txt' for s in chain],
+                                              [get_slurm_state_file(root_dir,s,args.project)+'_${SLURM_JOB_ID}.txt' for s in chain])
+                output_dir = get_output_dir(root_dir,stage,args.project)
+                jobid = submit_slurm_core(template,f'{stage}_to_{chain[-1]}_{args.project}','',nproc,
+                                          sbatch_config['architecture'][constraint][partition]['cores_per_node'],
+                                          threads,format_walltime(seconds),args.dry_run,output_dir,site,
+                                          os.path.join(get_project_dir(root_dir,args.project),f'slurm_out_fused_{stage}_{args.project}_{site}'),
+                                          get_sbatch_script_file_root(output_dir,args.project,stage,site),
+                                          depstr=depstr,account=get_default(sbatch_config,'account',args.account),
+                                          qos=get_default(sbatch_config,'qos',args.qos),partition=partition,constraint=constraint,
+                                          threads_per_core=get_tpc(sbatch_config,constraint,partition),extra=args.extra,
+                                          backend=backend)
+                for i,s in enumerate(chain):
+                    if not(args.dry_run):
+                        records[s] = get_index_record(jobid,site,None,fingerprints[s],git_fingerprints[s])
+                        records[s]['marked'] = True
+                        inputs = now_deps if i==0 else [chain[i-1]]
+                        records[s]['inputs'] = {d: records[d]['jobid'] for d in inputs if d in records}
+                        save_stage_config(root_dir,s,args.project,records[s],ostages[s],pkg_gitdict,pth_gitdict)
+                    jobids[s] = jobid
+                    depids[s] = jobid
+                continue
+
+            if stage in sweep_todo:
+                sweep = ostages[stage].sweep
+                todo = sweep_todo[stage]
+                execution,script,pargs = get_command(global_vals, ostages, stage)
+                output_dir = get_output_dir(root_dir,stage,args.project)
+                os.makedirs(output_dir, exist_ok=True)
+                # The points decide their options and paths when they run
+                point_output_dir = get_output_dir(root_dir,f'{stage}_{SWEEP_LABEL}',args.project)
+                point_out_file_root = get_out_file_root(root_dir,f'{stage}_{SWEEP_LABEL}',args.project,site)
+                parallel_config = ostages[stage].get('parallel',None)
+                if ostages[stage].get('farm',False):
+                    tasks = {'stage': stage,
+                             'cmds': shlex.split(' '.join([execution,script,pargs])),
+                             'strides': sweep.strides if sweep.mode=='product' else None,
+                             'sizes': [len(values) for values in sweep.values],
+                             'options': [[shlex.split(f) for f in fragments] for fragments in get_sweep_fragments(sweep)],
+                             'labels': [[f'{name}{v}' for v in values] for name,values in zip(sweep.names,sweep.values)],
+                             'indices': format_array(todo),
+                             'output_dir': point_output_dir,
+                             'out_file': point_out_file_root,
+                             'marker': get_slurm_state_file(root_dir,f'{stage}_{SWEEP_LABEL}',args.project),
+                             'failed_file': os.path.join(output_dir,f'farm_failed_{stage}_{args.project}')}
+                    tasks_file = os.path.join(output_dir,f'farm_tasks_{stage}_{args.project}_{int(time.time()*1e3)}.json')
+                    if not(args.dry_run):
+                        with open(tasks_file,'w') as f:
+                            json.dump(tasks,f)
+                    jobid = submit_slurm(stage,sbatch_config,parallel_config,
+                                         shlex.quote(sys.executable),'-m mbatch.farm',shlex.quote(tasks_file),
+                                         dry_run=args.dry_run,output_dir=output_dir,project=args.project,
+                                         site=site,root_dir=root_dir,depstr=depstr,account=args.account,
+                                         qos=args.qos,partition=args.partition,constraint=args.constraint,
+                                         extra=args.extra,backend=backend)
+                    array_jobids = [jobid]
+                else:
+                    # One job array for all the points (or several, see get_array_chunks())
+                    values_file = os.path.join(output_dir,f'sweep_values_{stage}_{args.project}_{int(time.time()*1e3)}.txt')
+                    if not(args.dry_run): write_sweep_values(values_file,sweep)
+                    array_limit = (parallel_config or {}).get('array_limit',None)
+                    chunks = []
+                    for offset,task_ids in get_array_chunks(todo,get_max_array_size(sbatch_config,backend)):
+                        array = format_array(task_ids)
+                        if array_limit is not None: array = f'{array}%{array_limit}'
+                        array_jobid = submit_slurm(stage,sbatch_config,parallel_config,
+                                                   execution,script,(pargs+' "$@"').strip(),
+                                                   dry_run=args.dry_run,output_dir=output_dir,project=args.project,
+                                                   site=site,root_dir=root_dir,depstr=depstr,account=args.account,
+                                                   qos=args.qos,partition=args.partition,constraint=args.constraint,
+                                                   extra=args.extra,array=array,backend=backend,
+                                                   preamble=get_sweep_preamble(sweep,values_file,offset,point_output_dir,point_out_file_root))
+                        chunks.append([array_jobid,offset])
+                    jobid = chunks[0][0]
+                    array_jobids = [c[0] for c in chunks]
+                if not(args.dry_run):
+                    records[stage] = get_index_record(jobid,site,None,fingerprints[stage],git_fingerprints[stage])
+                    records[stage]['sweep'] = sweep.spec
+                    # Until they are seen completing
+                    records[stage]['failed'] = format_array(todo)
+                    if ostages[stage].get('farm',False): records[stage]['farm'] = True
+                    else: records[stage]['chunks'] = chunks
+                    records[stage]['inputs'] = {d: records[d]['jobid'] for d in now_deps if d in records}
+                    save_stage_config(root_dir,stage,args.project,records[stage],ostages[stage],pkg_gitdict,pth_gitdict)
+                jobids[stage] = jobid
+                depids[stage] = ':'.join(array_jobids)
+                continue
+
+            parent = ostages[stage].parent
+            # Run all remaining iterations of a looped stage in one MPI job
+            # that hands them out to its ranks (see farm.py)
+            if (parent is not None) and ostages[stage].get('farm',False):
+                members = [s for s in unroll_map[parent] if not(s in args.skip) and not(s in reuse_stages)]
+                tasks = []
+                for s in members:
+                    execution,script,pargs = get_command(global_vals, ostages, s)
+                    s_output_dir = get_output_dir(root_dir,s,args.project)
+                    os.makedirs(s_output_dir, exist_ok=True)
+                    tasks.append({'stage': s,
+                                  'cmds': shlex.split(' '.join([execution,script,pargs])) + ['--output-dir',s_output_dir],
+                                  'out_file': get_out_file_root(root_dir,s,args.project,site),
+                                  'marker': get_slurm_state_file(root_dir,s,args.project)})
+                output_dir = get_output_dir(root_dir,parent,args.project)
+                os.makedirs(output_dir, exist_ok=True)
+                tasks_file = os.path.join(output_dir,f'farm_tasks_{parent}_{args.project}_{int(time.time()*1e3)}.json')
+                if not(args.dry_run):
+                    with open(tasks_file,'w') as f:
+                        json.dump(tasks,f)
+                farm_jobid = submit_slurm(parent,sbatch_config,
+                                          ostages[stage].get('parallel',None),
+                                          shlex.quote(sys.executable),'-m mbatch.farm',shlex.quote(tasks_file),
+                                          dry_run=args.dry_run,
+                                          output_dir=output_dir,
+                                          project=args.project,
+                                          site=site,root_dir=root_dir,depstr=depstr,
+                                          account=args.account,
+                                          qos=args.qos,
+                                          partition=args.partition,
+                                          constraint=args.constraint,extra=args.extra,
+                                          backend=backend)
+                # The iterations share their dependencies, and so their inputs
+                inputs = {d: records[d]['jobid'] for d in now_deps if d in records}
+                for s in members:
+                    jobids[s] = farm_jobid
+                    depids[s] = farm_jobid
+                    if not(args.dry_run):
+                        records[s] = get_index_record(farm_jobid,site,None,fingerprints[s],git_fingerprints[s])
+                        records[s]['marked'] = True
+                        records[s]['inputs'] = inputs
+                        save_stage_config(root_dir,s,args.project,records[s],ostages[s],pkg_gitdict,pth_gitdict)
+                continue
+
+            # Submit all remaining iterations of a looped stage as one job array,
+            # or as several if there are more than the cluster allows in one
+            if is_sbatch and (parent is not None) and not(args.no_array):
+                members = [s for s in unroll_map[parent] if not(s in args.skip) and not(s in reuse_stages)]
+                output_dirs = []
+                for s in members:
+                    output_dirs.append(get_output_dir(root_dir,s,args.project))
+                    os.makedirs(output_dirs[-1], exist_ok=True)
+                out_file_roots = [get_out_file_root(root_dir,s,args.project,site) for s in members]
+                execution,script,pargs = get_command(global_vals, ostages, stage, arg=ARRAY_ARG)
+                pargs = pargs.replace(ARRAY_ARG,'"$MBATCH_ARG"')
+                task_args = [ostages[s].arg for s in members]
+                output_dir = get_output_dir(root_dir,parent,args.project)
+                os.makedirs(output_dir, exist_ok=True)
+                tasks_file = os.path.join(output_dir,f'array_tasks_{parent}_{args.project}_{int(time.time()*1e3)}.txt')
+                if not(args.dry_run): write_array_tasks(tasks_file,task_args,output_dirs,out_file_roots)
+                parallel_config = ostages[stage].get('parallel',None)
+                array_limit = (parallel_config or {}).get('array_limit',None)
+                # The iterations share their dependencies, and so their inputs
+                inputs = {d: records[d]['jobid'] for d in now_deps if d in records}
+                array_jobids = []
+                for offset,task_ids in get_array_chunks(range(len(members)),get_max_array_size(sbatch_config,backend)):
+                    preamble = get_array_preamble(tasks_file,offset)
+                    array = format_array(task_ids)
+                    if array_limit is not None: array = f'{array}%{array_limit}'
+                    array_jobid = submit_slurm(parent,sbatch_config,
+                                               parallel_config,
+                                               execution,script,pargs,
+                                               dry_run=args.dry_run,
+                                               output_dir=output_dir,
+                                               project=args.project,
+                                               site=site,root_dir=root_dir,depstr=depstr,
+                                               account=args.account,
+                                               qos=args.qos,
+                                               partition=args.partition,
+                                               constraint=args.constraint,extra=args.extra,
+                                               array=array,preamble=preamble,backend=backend)
+                    array_jobids.append(array_jobid)
+                    for k in task_ids:
+                        s = members[offset+k]
+                        jobids[s] = f'{array_jobid}_{k}'
+                        if not(args.dry_run):
+                            records[s] = get_index_record(jobids[s],site,None,fingerprints[s],git_fingerprints[s])
+                            records[s]['inputs'] = inputs
+                            save_stage_config(root_dir,s,args.project,records[s],ostages[s],pkg_gitdict,pth_gitdict)
+                # Stages that depend on the looped stage wait for all of its arrays
+                for s in members: depids[s] = ':'.join(array_jobids)
+                continue
+
+            # Get command
+            execution,script,pargs = get_command(global_vals, ostages, stage)
+
+            # Make output directory
+            output_dir =  get_output_dir(root_dir,stage,args.project)
+            os.makedirs(output_dir, exist_ok=True)
+
             jobid = submit_slurm(stage,sbatch_config,
-                                 copy.deepcopy(ostages[stage]).get('parallel',None),
+                                 ostages[stage].get('parallel',None),
                                  execution,script,pargs,
                                  dry_run=args.dry_run,
                                  output_dir=output_dir,
@@ -809,32 +2594,211 @@ def main():
                                  account=args.account,
                                  qos=args.qos,
                                  partition=args.partition,
-                                 constraint=args.constraint,extra=args.extra)
-        if is_local:
-            if pargs=='':
-                cmds = [execution,script, '--output-dir',output_dir]
-            else:
-                cmds = [execution,script, pargs, '--output-dir',output_dir]
-            run_local(cmds,dry_run=args.dry_run)
-            
-            # Get current time in Unix milliseconds and use that as jobid
-            jobid = str(int(time.time()*1e3))
-            # Save job completion confirmation
-            with open(get_local_out_file(root_dir,stage,args.project)+f"_{jobid}.txt",'w') as f:
-                f.write('COMPLETED')
-
+                                 constraint=args.constraint,extra=args.extra,
+                                 backend=backend)
+
+            if not(args.dry_run):
+                records[stage] = get_index_record(jobid,site,None,fingerprints[stage],git_fingerprints[stage])
+                # The inputs are only hashed once this job is seen completed
+                records[stage]['inputs'] = {d: records[d]['jobid'] for d in now_deps if d in records}
+                save_stage_config(root_dir,stage,args.project,records[stage],ostages[stage],pkg_gitdict,pth_gitdict)
+
+            jobids[stage] = jobid
+            depids[stage] = jobid
+
+        def _stage(node):
+            # The stage (or sweep) that a local command is part of
+            return node_stage[node][0] if node in node_stage else node
+        # The points of a sweep depend on what the sweep depends on, and
+        # stages that depend on a sweep depend on all of its points
+        local_deps = {}
+        shared_deps = {}
+        for node in local_cmds:
+            stage = _stage(node)
+            if not(stage in shared_deps):
+                shared_deps[stage] = []
+                for d in deps.get(stage,[]):
+                    if d in sweep_nodes: shared_deps[stage].extend(sweep_nodes[d])
+                    elif d in local_cmds: shared_deps[stage].append(d)
+            local_deps[node] = shared_deps[stage]
+
+        if args.allocation and len(local_cmds)>0:
+            constraint = get_default(sbatch_config,'constraint',args.constraint)
+            partition = get_default(sbatch_config,'part',args.partition)
+            cpn = sbatch_config['architecture'][constraint][partition]['cores_per_node']
+            tpc = get_tpc(sbatch_config,constraint,partition)
+            stage_parallel = {}
+            for node in local_cmds:
+                stage = _stage(node)
+                if not(stage in stage_parallel):
+                    stage_parallel[stage] = get_stage_parallel(stage,sbatch_config,ostages[stage].get('parallel',None),constraint,partition)
+
+        if args.allocation and not(in_allocation) and len(local_cmds)>0:
+            # One job, as big as the most the stages can use at the same time
+            cores = {node: get_step_cores(*stage_parallel[_stage(node)][:2],cpn) for node in local_cmds}
+            walltimes = {node: parse_walltime(stage_parallel[_stage(node)][2]) for node in local_cmds}
+            max_nodes = args.max_nodes if args.max_nodes is not None else sbatch_config.get('max_allocation_nodes',DEFAULT_MAX_ALLOCATION_NODES)
+            num_nodes,seconds = get_allocation_size(list(local_cmds.keys()),local_deps,cores,walltimes,cpn,max_nodes=max_nodes)
+            print(f"Requesting one allocation of {num_nodes} node(s) for {format_walltime(seconds)} to run {len(stage_parallel)} stages in...")
+            # The job runs this same command (which then finds itself in the
+            # allocation) once, and not through the launcher in the template
+            cmd = [sys.executable,'-c','from mbatch.mbatch import main; main()'] + sys.argv[1:] + ['--yes']
+            if (args.site is None) and not(args.emulate): cmd = cmd + ['--site',site]
+            template = '\n'.join(['!CMD' if '!CMD' in line else line for line in sbatch_config['template'].split('\n')])
+            jobid = submit_slurm_core(template,f'allocation_{args.project}',' '.join([shlex.quote(c) for c in cmd]),
+                                      num_nodes*cpn,cpn,1,format_walltime(seconds),args.dry_run,proj_dir,site,
+                                      os.path.join(proj_dir,f'slurm_out_allocation_{args.project}_{site}'),
+                                      os.path.join(proj_dir,f'slurm_submission_allocation_{args.project}_{site}'),
+                                      account=get_default(sbatch_config,'account',args.account),
+                                      qos=get_default(sbatch_config,'qos',args.qos),
+                                      partition=partition,constraint=constraint,threads_per_core=tpc,extra=args.extra,
+                                      preamble=f'cd {shlex.quote(os.getcwd())}',backend=backend)
+            for stage in stage_parallel:
+                # The last record of the stage stays until the job has run it,
+                # so that early cutoff can use it and a failed job loses nothing
+                if not(args.dry_run): index.setdefault('pending',{})[stage] = {'jobid': str(jobid), 'site': site}
+                jobids[stage] = jobid
+            # The job records the stages it runs in the index itself
+            if not(args.dry_run): save_index(root_dir,args.project,index)
+            local_cmds = {}
+
+        launches = {} # How each stage is launched, which is the same for all the points of a sweep
+        if in_allocation and len(local_cmds)>0:
+            # Launch each stage as a step of this allocation, on the nodes it
+            # would get as a job of its own
+            ncores = int(os.environ.get('SLURM_JOB_NUM_NODES',os.environ.get('SLURM_NNODES','1')))*cpn
+            memory_gb = None
+            resources = {}
+            local_envs = {}
+            for node in local_cmds:
+                stage = _stage(node)
+                if not(stage in launches):
+                    nproc,threads,walltime = stage_parallel[stage]
+                    launcher = ['srun','--exclusive',f'--nodes={get_num_nodes(nproc,threads,cpn)}',
+                                f'--ntasks={nproc}',f'--cpus-per-task={tpc*threads}']
+                    if parse_walltime(walltime) is not None: launcher.append(f'--time={walltime}')
+                    launches[stage] = (launcher,{var: str(threads) for var in THREAD_ENV_VARS},(get_step_cores(nproc,threads,cpn),0.))
+                launcher,local_envs[node],resources[node] = launches[stage]
+                local_cmds[node] = launcher + local_cmds[node]
+        elif is_local and len(local_cmds)>0:
+            # Treat this machine as a single node, and launch each stage with
+            # the MPI processes and threads it would get on a cluster
+            ncores = args.local_cores if args.local_cores is not None else (os.cpu_count() or 1)
+            memory_gb = args.local_memory_gb if args.local_memory_gb is not None else get_machine_memory_gb()
+            arch = {'cores_per_node': ncores, 'memory_per_node_gb': memory_gb}
+            resources = {}
+            local_envs = {}
+            for node in local_cmds:
+                stage = _stage(node)
+                if not(stage in launches):
+                    parallel_config = ostages[stage].get('parallel',None) or {}
+                    nproc = parallel_config.get('nproc',1)
+                    # Unlike on a cluster, stages that don't say otherwise get one thread
+                    threads = get_threads(stage,parallel_config,arch,default=1)
+                    launcher = get_mpi_launcher(nproc,args.mpirun)
+                    if launcher is None:
+                        fprint(HTML(f"<ansiyellow>No mpirun or mpiexec found. Running stage {stage} as one process instead of nproc={nproc}.</ansiyellow>"))
+                        launcher = []
+                        nproc = 1
+                    launches[stage] = (launcher,{var: str(threads) for var in THREAD_ENV_VARS},
+                                       (nproc*threads,nproc*parallel_config.get('memory_gb',0.)))
+                launcher,local_envs[node],resources[node] = launches[stage]
+                local_cmds[node] = launcher + local_cmds[node]
+
+        if args.dry_run:
+            for node in local_cmds: run_local(local_cmds[node],dry_run=True,env=local_envs[node])
+        elif len(local_cmds)>0:
+            # Run each local stage as soon as the stages it depends on
+            # have finished, as long as there are enough cores and memory
+            print(f"Running {len(local_cmds)} {'stages' if len(sweep_nodes)==0 else 'stages and points'} "
+                  f"{'in this allocation' if in_allocation else 'locally'} on {ncores} cores"
+                  + (f" and {memory_gb:.1f} GB of memory..." if memory_gb is not None else "..."))
+            output_hashes = {}
+            local_jobids = {}
+            cutoff = {} # Whether each of the cutoff_stages got the inputs it was last run with
+            sweep_left = {stage: len(nodes) for stage,nodes in sweep_nodes.items()}
+            sweep_failed = {stage: [] for stage in sweep_nodes}
+            sweep_errors = {stage: 0 for stage in sweep_nodes}
+
+            def _run(node):
+                # Early cutoff: the stages this one depends on were re-run, but
+                # reproduced the outputs this stage was last run with
+                stage = _stage(node)
+                if stage in cutoff_stages:
+                    if not(stage in cutoff):
+                        input_hash = records[stage].get('input_hash',None)
+                        cutoff[stage] = (input_hash is not None) and (get_input_hash(deps[stage],records)==input_hash)
+                    if cutoff[stage]: return 'REUSED'
+                jobid = local_jobids[node] = get_local_jobid()
+                run_local(local_cmds[node],log_file=get_local_log_file(root_dir,node,args.project,jobid),
+                          echo=not(args.no_echo),prefix=f'[{node}] ' if len(local_cmds)>1 else '',
+                          env=local_envs[node])
+                # If others depend on this stage, hash what it wrote
+                if (node in depended) and not(args.no_output_hash): output_hashes[node] = get_output_hash(get_output_dir(root_dir,node,args.project))
+                return 'COMPLETED'
+
+            def _finish(node,state):
+                stage = _stage(node)
+                if stage in sweep_nodes:
+                    # A sweep is done once all of its points are
+                    if not(state in ['COMPLETED','REUSED']):
+                        sweep_failed[stage].append(node_stage[node][1])
+                        if state=='FAILED':
+                            fprint(HTML(f"<red>Point {node} of {stage} failed.</red>"))
+                            sweep_errors[stage] += 1
+                    sweep_left[stage] -= 1
+                    if sweep_left[stage]>0: return
+                    if state!='REUSED':
+                        if len(sweep_failed[stage])==0: state = 'COMPLETED'
+                        elif sweep_errors[stage]>0: state = 'FAILED'
+                        else: state = 'CANCELLED'
+                if in_allocation and (index.get('pending',{}).pop(stage,None) is not None):
+                    save_index(root_dir,args.project,index)
+                if state=='REUSED':
+                    fprint(HTML(f"<ansiyellow>Reusing stage {stage} since the stages it depends on reproduced its inputs.</ansiyellow>"))
+                    reuse_stages.add(stage)
+                    return
+                if (stage in sweep_nodes) and (state=='FAILED'):
+                    # The points that did complete are recorded, so that only the others are run again
+                    fprint(HTML(f"<red>{len(sweep_failed[stage])} of {len(sweep_nodes[stage])} points of {stage} did not complete.</red>"))
+                elif state!='COMPLETED':
+                    fprint(HTML(f"<red>Stage {stage} {'failed' if state=='FAILED' else 'was not run since a stage it depends on failed'}.</red>"))
+                    return
+                jobid = get_local_jobid() if stage in sweep_nodes else local_jobids[node]
+                if state=='COMPLETED':
+                    # Save job completion confirmation
+                    with open(get_local_out_file(root_dir,stage,args.project)+f"_{jobid}.txt",'w') as f:
+                        f.write('COMPLETED')
+                records[stage] = get_index_record(jobid,site,state,fingerprints[stage],git_fingerprints[stage])
+                if stage in sweep_nodes:
+                    records[stage]['sweep'] = ostages[stage].sweep.spec
+                    records[stage]['failed'] = format_array(sorted(sweep_failed[stage]))
+                    if (state=='COMPLETED') and (stage in depended) and not(args.no_output_hash):
+                        output_hashes[stage] = get_sweep_output_hash(root_dir,stage,args.project,ostages[stage].sweep)
+                # Hash the inputs this stage read
+                if state=='COMPLETED': records[stage]['input_hash'] = get_input_hash(deps.get(stage,[]),records)
+                else: records[stage]['inputs'] = {d: records[d]['jobid'] for d in deps.get(stage,[]) if d in records}
+                if stage in output_hashes: records[stage]['output_hash'] = output_hashes[stage]
+                save_stage_config(root_dir,stage,args.project,records[stage],ostages[stage],pkg_gitdict,pth_gitdict)
+                # Local runs can take a while, so we record each of them right away
+                save_index(root_dir,args.project,index)
+                jobids[stage] = jobid
+
+            states = run_dag(list(local_cmds.keys()),local_deps,resources,_run,_finish,ncores,memory_gb)
+            failed = list(dict.fromkeys([_stage(node) for node,state in states.items() if state=='FAILED']))
+            if len(failed)>0: raise_exception(f"Stage(s) {', '.join(failed)} failed. See earlier error messages.")
+
+        # Emulated jobs only run as long as this process does
         if not(args.dry_run):
-            out_dict = {}
-            out_dict['stage'] = {stage: copy.deepcopy(ostages[stage])}
-            out_dict['stage']['pkg_gitdict'] = pkg_gitdict
-            out_dict['stage']['pth_gitdict'] = pth_gitdict
-            init_time_ms = int(time.time()*1e3) # Save time when it was saved
-            out_dict['stage']['time'] = init_time_ms
-            with open(get_stage_config_filename(root_dir,stage,args.project,jobid), 'w') as f:
-                yaml.dump(out_dict, f, default_flow_style=False)
-
-        jobids[stage] = jobid
-    
+            prof.phase('waiting')
+            backend.wait()
+            if args.allocation and not(in_allocation) and len(jobids)>0: index = load_index(root_dir,args.project)
+
+    finally:
+        # Record what was submitted, even if a later submission failed
+        if not(args.dry_run): save_index(root_dir,args.project,index)
+        prof.report(os.path.join(get_project_dir(root_dir,args.project),'mbatch_profile.json'))
+
 
 if __name__ == '__main__':
     main()
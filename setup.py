@@ -62,6 +62,7 @@ setup(
     'console_scripts': ['mbatch=mbatch.mbatch:main','wmpi=mbatch.wmpi:main'],
     },
     install_requires=requirements,
+    extras_require={'farm': ['mpi4py']},
     license="BSD license",
     long_description=readme + '\n\n' + history,
     package_data={'mbatch': ['mbatch/data/sites/*.yml']},